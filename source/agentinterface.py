@@ -6,13 +6,21 @@ Provides capabilities for an AI agent to modify and interact with the TreeLine d
 """
 
 import json
+import html
+import re
 import sys
 import os
 import uuid
 import pathlib
+import asyncio
+import base64
+import itertools
+import collections
+import contextlib
+import traceback
 import anthropic
-from PyQt5.QtCore import Qt, QSize, pyqtSignal, QSettings
-from PyQt5.QtGui import QTextCursor, QIcon, QTextCharFormat, QColor
+from PyQt5.QtCore import Qt, QSize, QObject, QThread, pyqtSignal, QSettings
+from PyQt5.QtGui import QIcon
 from PyQt5.QtWidgets import (QDialog, QVBoxLayout, QHBoxLayout, QPushButton, 
                            QLabel, QTextEdit, QLineEdit, QProgressBar,
                            QSplitter, QApplication, QMessageBox, QInputDialog)
@@ -21,56 +29,200 @@ import globalref
 import optiondefaults
 import treestructure
 import treenode
+import nodeformat
 import treemodel
 import treespot
 import treespotlist
 from treeselection import TreeSelection
 
+# Maximum number of seconds to wait between streamed response chunks
+_STREAM_IDLE_TIMEOUT = 30
 
-class AgentInterface:
+# Agent instructions shipped alongside this module
+_SYS_PROMPT_PATH = pathlib.Path(__file__).parent / "SYS_PROMPT.md"
+
+# Body of the first ``` or ```json code fence; an unclosed fence runs to the end
+_FENCE_RE = re.compile(r"```(?:json)?\s*(.*?)(?:```|$)", re.DOTALL)
+
+# Trees with at least this many nodes are formatted off the GUI thread
+_THREADED_STRUCTURE_NODES = 5000
+
+# Characters that matter when scanning text for JSON objects, and the
+# start of a possible object: a brace before a key or a closing brace
+_JSON_SPECIAL_RE = re.compile(r'[{}"\\]')
+_JSON_OBJECT_START_RE = re.compile(r'{\s*["}]')
+
+_agent_settings = None
+
+
+def _get_settings():
+    """Return the shared TreeLine settings object, creating it on first use."""
+    global _agent_settings
+    if _agent_settings is None:
+        _agent_settings = QSettings(QSettings.IniFormat, QSettings.UserScope,
+                                    'TreeLine', 'TreeLine')
+    return _agent_settings
+
+
+def _find_json_objects(text):
+    """Return the outermost JSON object spans in text.
+    
+    The text is walked once, pairing braces and ignoring those inside
+    string literals of the objects.  Outside of any object, only a brace
+    before a key or a closing brace starts one, so stray braces in prose
+    are passed over.  Each closed span is then parsed, outermost first,
+    and the spans inside a valid object are skipped.
+    
+    Args:
+        text: Text that may contain JSON objects
+        
+    Returns:
+        List of JSON object strings in order of appearance
+    """
+    closed = []
+    open_starts = []
+    in_string = False
+    escaped_pos = -1
+    for match in _JSON_SPECIAL_RE.finditer(text):
+        pos = match.start()
+        if pos == escaped_pos:
+            continue
+        char = match.group()
+        if in_string:
+            if char == '\\':
+                escaped_pos = pos + 1
+            elif char == '"':
+                in_string = False
+        elif char == '{':
+            if open_starts or _JSON_OBJECT_START_RE.match(text, pos):
+                open_starts.append(pos)
+        elif open_starts:
+            if char == '}':
+                closed.append((open_starts.pop(), pos + 1))
+            elif char == '"':
+                in_string = True
+    
+    # Outer spans close after their inner ones, so order them by start
+    closed.sort()
+    spans = []
+    covered_end = 0
+    for start, end in closed:
+        if start < covered_end:
+            continue
+        span = text[start:end]
+        try:
+            json.loads(span)
+        except (ValueError, RecursionError):
+            # Not valid JSON, but an object inside it may be
+            continue
+        spans.append(span)
+        covered_end = end
+    return spans
+
+
+class AgentInterface(QObject):
     """Interface for AI agent to interact with TreeLine data structure."""
     
+    chunkReceived = pyqtSignal(str)
+    
+    # Actions callable by the agent, each handled by an _action_<name> method
+    _ACTION_NAMES = frozenset(('add_node', 'edit_node', 'delete_node',
+                               'move_node', 'get_node', 'search_nodes',
+                               'get_format_types', 'create_format_type',
+                               'get_tree_structure', 'get_tree_page',
+                               'get_node_path', 'get_node_children',
+                               'get_node_siblings', 'find_node_by_title'))
+    
+    # Fallback field data for new root nodes of the standard format types
+    _DEFAULT_DATA_BY_FORMAT = {
+        'HEADINGS': {'Heading': 'New Heading'},
+        'BULLETS': {'Text': 'New bullet item'},
+        'HEAD_PARA': {'Heading': 'New Heading', 'Text': 'New paragraph text'},
+    }
+    
     def __init__(self, local_control):
         """Initialize the agent interface with reference to local control.
         
         Args:
             local_control: Reference to TreeLocalControl for the active window
         """
+        super().__init__()
         self.local_control = local_control
         self.tree_structure = local_control.structure
         self.tree_model = local_control.model
         self.tree_view = local_control.activeWindow.treeView
         self.selection = local_control.activeWindow.treeView.selectionModel()
         self.client = None
+        self._cached_api_key = None
+        # Bound handler for each action name, resolved once
+        self._action_table = {name: getattr(self, '_action_' + name)
+                              for name in self._ACTION_NAMES}
+        self._event_loop = asyncio.new_event_loop()
+        # Task of the API request being waited for, and whether it should
+        # be cancelled, possibly before the task is created
+        self._completion_task = None
+        self._cancel_requested = False
         self._initialize_anthropic_client()
         
         # Keep track of recent actions and context
-        self.message_history = []
+        # Only the most recent messages are sent, so older ones are dropped
+        self.message_history = collections.deque(maxlen=64)
         self.action_results = {}
         self.last_created_node_id = None
-        self.last_api_request_log = ""
-        self.debug_node_titles = []
+        self._last_log_data = None
+        
+        # Title lookup indexes, built on first use
+        self._title_index = None
+        self._title_index_folded = None
+        self._title_lookup_cache = {}
+        
+        # Incremented on every tree change to invalidate cached node data
+        self._mut_counter = 0
+        # Incremented only by the agent's own edits, to tell when the
+        # views need refreshing after a run of actions
+        self._edit_count = 0
+        self._node_dict_cache = {}
+        self._node_dict_cache_token = 0
+        self._title_cache = {}
+        self._title_cache_token = 0
+        # Last get_tree_structure result, keyed by (_mut_counter, max_depth)
+        self._tree_structure_cache = (None, None)
+        
+        # Set while batch_execute runs to defer view updates
+        self._in_batch = False
+        
+        # Edits made in the main window also invalidate the cached tree data
+        self._connect_tree_signals()
+        
+        # Prompt inputs that rarely change within a session
+        self._sys_prompt_cached = None
+        self._format_types_cached = None
+        self._format_types_json_cached = None
     
     def _initialize_anthropic_client(self):
         """Initialize the Anthropic API client if API key is available."""
         api_key = self._get_api_key()
         if api_key:
             try:
-                self.client = anthropic.Anthropic(api_key=api_key)
+                self.client = anthropic.AsyncAnthropic(api_key=api_key)
             except Exception as e:
                 print(f"Error initializing Anthropic client: {e}")
     
     def _get_api_key(self):
-        """Get Anthropic API key from environment variable or settings."""
+        """Get Anthropic API key from environment variable or settings.
+        
+        The key is looked up once and cached until set_api_key is called.
+        """
+        if self._cached_api_key is not None:
+            return self._cached_api_key
         # Try environment variable first
         api_key = os.environ.get('ANTHROPIC_API_KEY', '')
         
         # If not in environment, try settings
         if not api_key:
-            settings = QSettings(QSettings.IniFormat, QSettings.UserScope,
-                               'TreeLine', 'TreeLine')
-            api_key = settings.value('AgentApiKey', '')
+            api_key = _get_settings().value('AgentApiKey', '')
             
+        self._cached_api_key = api_key
         return api_key
     
     def set_api_key(self, api_key):
@@ -79,11 +231,102 @@ class AgentInterface:
         Args:
             api_key: Anthropic API key
         """
-        settings = QSettings(QSettings.IniFormat, QSettings.UserScope,
-                           'TreeLine', 'TreeLine')
-        settings.setValue('AgentApiKey', api_key)
+        _get_settings().setValue('AgentApiKey', api_key)
+        # Look the key up again, since the environment variable takes precedence
+        self._cached_api_key = None
         self._initialize_anthropic_client()
     
+    async def _stream_completion(self, system_message, messages):
+        """Stream a response from the Anthropic API.
+        
+        Emits chunkReceived for each text chunk as it arrives.
+        
+        Args:
+            system_message: System prompt text
+            messages: List of message dicts for the conversation
+            
+        Returns:
+            The complete response text
+            
+        Raises:
+            TimeoutError: If no chunk arrives within the idle timeout
+        """
+        chunks = []
+        async with self.client.messages.stream(
+            model="claude-3-opus-20240229",
+            max_tokens=1024,
+            temperature=0,
+            system=system_message,
+            messages=messages
+        ) as stream:
+            text_iter = stream.text_stream.__aiter__()
+            while True:
+                # Dead-man timer: fail if the stream stalls between chunks
+                try:
+                    text = await asyncio.wait_for(text_iter.__anext__(),
+                                                  _STREAM_IDLE_TIMEOUT)
+                except StopAsyncIteration:
+                    break
+                except asyncio.TimeoutError:
+                    raise TimeoutError(f'No response received for {_STREAM_IDLE_TIMEOUT} seconds')
+                chunks.append(text)
+                self.chunkReceived.emit(text)
+        return ''.join(chunks)
+    
+    def _get_completion(self, system_message, messages):
+        """Send a request and wait for the complete streamed response.
+        
+        Responses are not cached, since a reply's actions must not be
+        executed again against the current tree.
+        
+        Args:
+            system_message: System prompt text
+            messages: List of message dicts for the conversation
+            
+        Returns:
+            The complete response text
+            
+        Raises:
+            asyncio.CancelledError: If cancel_request was called
+        """
+        if self._event_loop.is_closed():
+            # Closed along with its client when the dialog was closed
+            self._event_loop = asyncio.new_event_loop()
+            self._initialize_anthropic_client()
+        self._completion_task = self._event_loop.create_task(
+            self._stream_completion(system_message, messages))
+        if self._cancel_requested:
+            self._completion_task.cancel()
+        try:
+            return self._event_loop.run_until_complete(self._completion_task)
+        finally:
+            self._completion_task = None
+    
+    def close_event_loop(self):
+        """Close the API client and the event loop used for its requests.
+        
+        Must not be called while a request is running.  The next request
+        creates a new loop and client.
+        """
+        if self._event_loop.is_closed():
+            return
+        if self.client is not None:
+            try:
+                self._event_loop.run_until_complete(self.client.close())
+            except Exception as e:
+                print(f"Error closing Anthropic client: {e}")
+        self._event_loop.close()
+    
+    def cancel_request(self):
+        """Cancel the API request being waited for, if any.
+        
+        Safe to call from a thread other than the one waiting.
+        """
+        self._cancel_requested = True
+        task = self._completion_task
+        if task is not None:
+            self._event_loop.call_soon_threadsafe(task.cancel)
+    
     def get_tree_json(self, node=None):
         """Get JSON representation of the tree or a specific node.
         
@@ -93,6 +336,21 @@ class AgentInterface:
         Returns:
             JSON string representing the tree or node structure
         """
+        # Non-serializable values are converted to strings by the encoder
+        return json.dumps(self.get_tree_dict(node), indent=2, default=str)
+        
+    def get_tree_dict(self, node=None):
+        """Get a dictionary representation of the tree or a specific node.
+        
+        The result may be shared with the node data cache and must not be
+        modified.
+        
+        Args:
+            node: Optional node to get data for. If None, gets data for selected nodes.
+            
+        Returns:
+            Dictionary representing the tree or node structure
+        """
         if node is None:
             # Get currently selected node(s)
             selection = self.selection
@@ -107,28 +365,13 @@ class AgentInterface:
                 node = self.tree_structure.childList[0]
             else:
                 # Empty tree - return empty structure
-                empty_data = {
+                return {
                     "message": "Tree structure is empty - no nodes found",
                     "available_formats": [f for f in self.tree_structure.treeFormats]
                 }
-                return json.dumps(empty_data, indent=2)
         
         # Get node data in a dict format
-        node_data = self._get_node_data_dict(node)
-        
-        # Make sure data is JSON serializable
-        def sanitize_for_json(obj):
-            if isinstance(obj, dict):
-                return {k: sanitize_for_json(v) for k, v in obj.items()}
-            elif isinstance(obj, list):
-                return [sanitize_for_json(item) for item in obj]
-            elif isinstance(obj, (int, float, str, bool)) or obj is None:
-                return obj
-            else:
-                return str(obj)
-                
-        sanitized_data = sanitize_for_json(node_data)
-        return json.dumps(sanitized_data, indent=2)
+        return self._get_node_data_dict(node)
         
     def get_node_by_title(self, title):
         """Find a node by its title.
@@ -142,19 +385,129 @@ class AgentInterface:
         if not title or not isinstance(title, str):
             return None
             
-        # Log node titles for debugging
-        self.debug_node_titles = []
-        for node_id, node in self.tree_structure.nodeDict.items():
-            node_title = node.title()
-            self.debug_node_titles.append(f"Node {node_id}: '{node_title}'")
-            if node_title == title:
-                return node
-                
-        # Case-insensitive search as fallback
-        for node_id, node in self.tree_structure.nodeDict.items():
-            if node.title().lower() == title.lower():
+        # Results, including misses, are kept until the indexes change,
+        # unless a cached node has since been removed from the tree
+        node_dict = self.tree_structure.nodeDict
+        try:
+            node = self._title_lookup_cache[title]
+        except KeyError:
+            pass
+        else:
+            if node is None or node_dict.get(node.uId) is node:
                 return node
-        return None
+            self.refresh_tree_caches()
+        if self._title_index is None:
+            self._build_title_index()
+        node = self._title_index.get(title)
+        if node is None:
+            # Case-insensitive search as fallback, using Unicode case folding
+            node = self._title_index_folded.get(title.casefold())
+        if node is not None and node_dict.get(node.uId) is not node:
+            # The index predates a removal, so build it again
+            self.refresh_tree_caches()
+            self._build_title_index()
+            node = self._title_index.get(title)
+            if node is None:
+                node = self._title_index_folded.get(title.casefold())
+        self._title_lookup_cache[title] = node
+        return node
+    
+    def _build_title_index(self):
+        """Build the title to node lookup dictionaries.
+        
+        The first node found with a given title takes precedence.
+        """
+        self._title_index = {}
+        self._title_index_folded = {}
+        for node in self.tree_structure.nodeDict.values():
+            node_title = self._node_title(node)
+            self._title_index.setdefault(node_title, node)
+            self._title_index_folded.setdefault(node_title.casefold(), node)
+    
+    def _add_title_index_entry(self, node):
+        """Add a new node to the title indexes if they have been built.
+        
+        Args:
+            node: The node to add
+        """
+        if self._title_index is not None:
+            node_title = node.title()
+            self._title_index.setdefault(node_title, node)
+            self._title_index_folded.setdefault(node_title.casefold(), node)
+            # A new node can turn a cached miss into a match
+            self._title_lookup_cache.clear()
+    
+    def _invalidate_title_index(self):
+        """Discard the title indexes so they are rebuilt on the next lookup."""
+        self._title_index = None
+        self._title_index_folded = None
+        self._title_lookup_cache.clear()
+    
+    def _mark_tree_changed(self):
+        """Record a tree change so that cached node data is not reused."""
+        self._mut_counter += 1
+        self._edit_count += 1
+    
+    def _connect_tree_signals(self):
+        """Refresh the cached tree data whenever the main window edits the tree.
+        
+        Covers edits made through the tree model, the tree and data edit
+        views, and the menu commands, including undo and redo.
+        """
+        self.tree_model.treeModified.connect(self.refresh_tree_caches)
+        for window in self.local_control.windowList:
+            window.nodeModified.connect(self.refresh_tree_caches)
+            window.treeModified.connect(self.refresh_tree_caches)
+        for action in self.local_control.allActions.values():
+            action.triggered.connect(self.refresh_tree_caches)
+    
+    def refresh_tree_caches(self, *args):
+        """Discard all cached tree data before reading the tree again.
+        
+        The tree may have been edited in the main window, outside of the
+        agent's own actions.
+        
+        Args:
+            *args: Unused arguments from connected signals
+        """
+        self._invalidate_title_index()
+        self._mut_counter += 1
+        self._tree_structure_cache = (None, None)
+    
+    def _node_title(self, node):
+        """Return a node's title, cached until the tree changes.
+        
+        Args:
+            node: The node to get the title for
+            
+        Returns:
+            The node's title string
+        """
+        if self._title_cache_token != self._mut_counter:
+            self._title_cache.clear()
+            self._title_cache_token = self._mut_counter
+        node_title = self._title_cache.get(node.uId)
+        if node_title is None:
+            node_title = node.title()
+            self._title_cache[node.uId] = node_title
+        return node_title
+        
+    @property
+    def last_api_request_log(self):
+        """Return the last API request's log data formatted as JSON."""
+        if self._last_log_data is None:
+            return ""
+        try:
+            # Non-serializable values are converted to strings when encoding
+            return json.dumps(self._last_log_data, indent=2, default=str)
+        except Exception as e:
+            return f"Error creating log data: {str(e)}"
+    
+    @property
+    def debug_node_titles(self):
+        """Return a list of node ID and title strings for debugging."""
+        return [f"Node {node_id}: '{node.title()}'"
+                for node_id, node in self.tree_structure.nodeDict.items()]
         
     def get_debug_log(self):
         """Get the last API request log for debugging.
@@ -165,9 +518,10 @@ class AgentInterface:
         debug_info = ""
         
         # Node titles for debugging
-        if hasattr(self, 'debug_node_titles') and self.debug_node_titles:
+        debug_node_titles = self.debug_node_titles
+        if debug_node_titles:
             debug_info += "Node Title Mapping:\n"
-            debug_info += "\n".join(self.debug_node_titles)
+            debug_info += "\n".join(debug_node_titles)
             debug_info += "\n\n"
             
         # Add API request log
@@ -179,6 +533,9 @@ class AgentInterface:
     def _get_node_data_dict(self, node, depth=2):
         """Get node data as a dictionary.
         
+        Results are cached until the tree changes, so the returned
+        dictionary is shared and must not be modified by callers.
+        
         Args:
             node: The node to get data for
             depth: How many levels of children to include
@@ -186,30 +543,55 @@ class AgentInterface:
         Returns:
             Dictionary with node data
         """
-        # Make a serializable copy of the data
-        data_copy = {}
-        for key, value in node.data.items():
-            if hasattr(value, '__call__'):  # Check if it's a method
-                data_copy[key] = str(value)
-            else:
-                data_copy[key] = value
-                
+        if self._node_dict_cache_token != self._mut_counter:
+            self._node_dict_cache.clear()
+            self._node_dict_cache_token = self._mut_counter
+        cache = self._node_dict_cache
+        cached = cache.get((node.uId, depth))
+        if cached is not None:
+            return cached
+        
+        result = self._new_node_data_dict(node, depth)
+        cache[(node.uId, depth)] = result
+        
+        # Fill in children iteratively, reusing cached subtrees
+        stack = [(result, node, depth)]
+        while stack:
+            parent_result, parent, parent_depth = stack.pop()
+            if parent_depth <= 0:
+                continue
+            child_depth = parent_depth - 1
+            children = parent_result['children']
+            for child in parent.childList:
+                child_result = cache.get((child.uId, child_depth))
+                if child_result is None:
+                    child_result = self._new_node_data_dict(child, child_depth)
+                    cache[(child.uId, child_depth)] = child_result
+                    stack.append((child_result, child, child_depth))
+                children.append(child_result)
+        return result
+    
+    def _new_node_data_dict(self, node, depth):
+        """Create the dictionary for a single node with an empty children list.
+        
+        Args:
+            node: The node to get data for
+            depth: How many levels of children will be included
+            
+        Returns:
+            Dictionary with node data
+        """
+        # Copy the data; non-serializable values are handled when encoding
         result = {
-            'id': str(node.uId),
-            'title': node.title(),
-            'data': data_copy,
+            'id': node.uId,
+            'title': self._node_title(node),
+            'data': dict(node.data),
             'format_type': node.formatRef.name,
             'children': []
         }
-        
-        # Add children if depth allows
-        if depth > 0:
-            for child in node.childList:
-                result['children'].append(self._get_node_data_dict(child, depth-1))
-        elif node.childList:
+        if depth <= 0 and node.childList:
             # Indicate there are more children without including them
             result['has_more_children'] = True
-            
         return result
     
     def execute_action(self, action_type, **kwargs):
@@ -222,30 +604,57 @@ class AgentInterface:
         Returns:
             Dictionary with result status and data
         """
-        action_handlers = {
-            'add_node': self._action_add_node,
-            'edit_node': self._action_edit_node,
-            'delete_node': self._action_delete_node,
-            'move_node': self._action_move_node,
-            'get_node': self._action_get_node,
-            'search_nodes': self._action_search_nodes,
-            'get_format_types': self._action_get_format_types,
-            'create_format_type': self._action_create_format_type,
-            'get_tree_structure': self._action_get_tree_structure,
-            'get_node_path': self._action_get_node_path,
-            'get_node_children': self._action_get_node_children,
-            'get_node_siblings': self._action_get_node_siblings,
-            'find_node_by_title': self._action_find_node_by_title
-        }
+        handler = self._action_table.get(action_type)
+        if handler is None:
+            return {'status': 'error', 'message': f'Unknown action type: {action_type}'}
+        try:
+            return handler(**kwargs)
+        except Exception as e:
+            return {'status': 'error', 'message': str(e)}
+    
+    def batch_execute(self, actions):
+        """Execute a sequence of actions with a single view update at the end.
         
-        handler = action_handlers.get(action_type)
-        if handler:
-            try:
-                return handler(**kwargs)
-            except Exception as e:
-                return {'status': 'error', 'message': str(e)}
+        Args:
+            actions: List of dictionaries with 'action' and 'parameters' keys
+            
+        Returns:
+            List of result dictionaries, one per action
+        """
+        edit_count = self._edit_count
+        with self.deferred_updates():
+            results = [self.execute_action(item['action'], **item.get('parameters', {}))
+                       for item in actions]
+        if self._edit_count != edit_count:
+            self.local_control.updateAll()
+        return results
+    
+    @contextlib.contextmanager
+    def deferred_updates(self):
+        """Suppress per-action view updates and repaints within the block.
+        
+        The caller is responsible for a single view update afterwards.
+        """
+        self._in_batch = True
+        self.tree_view.setUpdatesEnabled(False)
+        try:
+            yield
+        finally:
+            self._in_batch = False
+            self.tree_view.setUpdatesEnabled(True)
+    
+    def _update_views(self, node=None):
+        """Refresh the views after a change unless a batch is running.
+        
+        Args:
+            node: Changed node to update, or None to update the full tree
+        """
+        if self._in_batch:
+            return
+        if node is not None:
+            self.local_control.updateTreeNode(node)
         else:
-            return {'status': 'error', 'message': f'Unknown action type: {action_type}'}
+            self.local_control.updateAll()
     
     def _action_add_node(self, parent_id=None, title='', data=None, format_type=None, position=None):
         """Add a new node to the tree.
@@ -263,28 +672,22 @@ class AgentInterface:
         # When parent_id is explicitly None, we'll add a root-level node
         if parent_id is None:
             # Create a new node with the specified format type
-            if format_type and format_type in self.tree_structure.treeFormats:
-                format_ref = self.tree_structure.treeFormats[format_type]
-            else:
+            tree_formats = self.tree_structure.treeFormats
+            format_ref = tree_formats.get(format_type) if format_type else None
+            if format_ref is None:
                 # Default to first format if none specified
-                format_names = self.tree_structure.treeFormats.typeNames()
-                if format_names:
-                    format_ref = self.tree_structure.treeFormats[format_names[0]]
-                    format_type = format_names[0]  # Save for verification below
-                else:
+                format_names = tree_formats.typeNames()
+                if not format_names:
                     return {'status': 'error', 'message': 'No format types available'}
+                format_type = format_names[0]  # Save for verification below
+                format_ref = tree_formats[format_type]
                     
             # Verify data is provided and has the required fields for this format type
             if not data:
                 # Create default data based on format type
-                data = {}
-                if format_type == "HEADINGS":
-                    data["Heading"] = title or "New Heading"
-                elif format_type == "BULLETS":
-                    data["Text"] = "New bullet item"
-                elif format_type == "HEAD_PARA":
-                    data["Heading"] = title or "New Heading"
-                    data["Text"] = "New paragraph text"
+                data = dict(self._DEFAULT_DATA_BY_FORMAT.get(format_type, {}))
+                if title and 'Heading' in data:
+                    data['Heading'] = title
                 
                 # Log a warning
                 print(f"Warning: No data provided for node with format_type: {format_type}. Using default values.")
@@ -308,11 +711,7 @@ class AgentInterface:
             parent_node = None
         else:
             # Find parent node - try by ID first, then by title if ID fails
-            parent_node = self._get_node_by_id(parent_id)
-            
-            # If not found and parent_id is a string that could be a title, try to find by title
-            if not parent_node and isinstance(parent_id, str) and not parent_id.startswith("parent_"):
-                parent_node = self.get_node_by_title(parent_id)
+            parent_node = self._find_node(parent_id, 'parent_')
                 
             if not parent_node:
                 return {'status': 'error', 'message': f'Parent node not found: {parent_id}'}
@@ -339,28 +738,34 @@ class AgentInterface:
                                              title)
             
             # Override format if specified after creation
-            if format_type and format_type in self.tree_structure.treeFormats:
-                new_format = self.tree_structure.treeFormats[format_type]
+            new_format = (self.tree_structure.treeFormats.get(format_type)
+                          if format_type else None)
+            if new_format is not None:
                 new_node.changeDataType(new_format)
         
         # Set additional data if provided (for both root and child nodes)
         if data:
+            field_dict = new_node.formatRef.fieldDict
             for field_name, value in data.items():
-                if field_name in new_node.formatRef.fieldDict:
-                    field = new_node.formatRef.fieldDict[field_name]
-                    try:
-                        new_node.setData(field, value)
-                    except ValueError:
-                        # If validation fails, we still continue with other fields
-                        pass
+                field = field_dict.get(field_name)
+                if field is None:
+                    continue
+                try:
+                    new_node.setData(field, value)
+                except ValueError:
+                    # If validation fails, we still continue with other fields
+                    pass
                     
+        self._add_title_index_entry(new_node)
+        self._mark_tree_changed()
+        
         # Update UI
-        self.local_control.updateAll()
+        self._update_views()
         
         return {
             'status': 'success', 
             'message': 'Node added',
-            'node_id': str(new_node.uId)
+            'node_id': new_node.uId
         }
     
     def _action_edit_node(self, node_id=None, title=None, data=None, format_type=None):
@@ -376,11 +781,7 @@ class AgentInterface:
             Dictionary with result status
         """
         # Find node - try by ID first, then by title
-        node = self._get_node_by_id(node_id)
-        
-        # If not found and node_id is a string that could be a title, try to find by title
-        if not node and isinstance(node_id, str) and not node_id.startswith("node_"):
-            node = self.get_node_by_title(node_id)
+        node = self._find_node(node_id)
             
         if not node:
             return {'status': 'error', 'message': f'Node not found: {node_id}'}
@@ -395,24 +796,29 @@ class AgentInterface:
         
         # Update title if specified (updates the first field of the node)
         if title is not None:
-            first_field = node.formatRef.fieldNames[0]
             # Use model setData to properly handle undo
             model_index = self.tree_model.createIndex(0, 0, node)
             self.tree_model.setData(model_index, title, Qt.EditRole, True)
         
         # Update data fields if specified
         if data:
+            field_dict = node.formatRef.fieldDict
             for field_name, value in data.items():
-                if field_name in node.formatRef.fieldDict:
-                    field = node.formatRef.fieldDict[field_name]
-                    try:
-                        node.setData(field, value)
-                    except ValueError:
-                        # If validation fails, we still continue with other fields
-                        pass
+                field = field_dict.get(field_name)
+                if field is None:
+                    continue
+                try:
+                    node.setData(field, value)
+                except ValueError:
+                    # If validation fails, we still continue with other fields
+                    pass
+        
+        # Title changes are not tracked incrementally (titles may be shared)
+        self._invalidate_title_index()
+        self._mark_tree_changed()
         
         # Update UI to reflect changes
-        self.local_control.updateTreeNode(node)
+        self._update_views(node)
         
         return {'status': 'success', 'message': 'Node updated'}
     
@@ -426,11 +832,7 @@ class AgentInterface:
             Dictionary with result status
         """
         # Find node - try by ID first, then by title
-        node = self._get_node_by_id(node_id)
-        
-        # If not found and node_id is a string that could be a title, try to find by title
-        if not node and isinstance(node_id, str) and not node_id.startswith("node_"):
-            node = self.get_node_by_title(node_id)
+        node = self._find_node(node_id)
             
         if not node:
             return {'status': 'error', 'message': f'Node not found: {node_id}'}
@@ -460,14 +862,15 @@ class AgentInterface:
             if node.uId in self.tree_structure.nodeDict:
                 print(f"Removing node from nodeDict: {node.uId}")
                 del self.tree_structure.nodeDict[node.uId]
+            self._invalidate_title_index()
+            self._mark_tree_changed()
             
             # Update the UI
-            self.local_control.updateAll(True)  # Force update
+            self._update_views()
             
             return {'status': 'success', 'message': f'Node "{node_title}" deleted successfully'}
             
         except Exception as e:
-            import traceback
             print(f"Error deleting node: {str(e)}")
             print(traceback.format_exc())
             return {'status': 'error', 'message': f'Failed to delete node: {str(e)}'}
@@ -485,18 +888,14 @@ class AgentInterface:
             Dictionary with result status
         """
         # Find nodes - try by ID first, then by title
-        node = self._get_node_by_id(node_id)
-        if not node and isinstance(node_id, str) and not node_id.startswith("node_"):
-            node = self.get_node_by_title(node_id)
+        node = self._find_node(node_id)
         
         if not node:
             return {'status': 'error', 'message': f'Node not found: {node_id}'}
             
         # If no target parent specified, use current parent
         if target_parent_id:
-            target_parent = self._get_node_by_id(target_parent_id)
-            if not target_parent and isinstance(target_parent_id, str) and not target_parent_id.startswith("node_"):
-                target_parent = self.get_node_by_title(target_parent_id)
+            target_parent = self._find_node(target_parent_id)
                 
             if not target_parent:
                 return {'status': 'error', 'message': f'Target parent node not found: {target_parent_id}'}
@@ -512,6 +911,9 @@ class AgentInterface:
             
         # Use TreeLocalControl's move command (handles undo/redo)
         self.local_control.moveNode(node, old_parent_spot, new_parent_spot, position)
+        # Titles may reference ancestor fields
+        self._invalidate_title_index()
+        self._mark_tree_changed()
         
         return {'status': 'success', 'message': 'Node moved'}
     
@@ -527,11 +929,7 @@ class AgentInterface:
             Dictionary with node data
         """
         # Find node - try by ID first, then by title
-        node = self._get_node_by_id(node_id)
-        
-        # If not found and node_id is a string that could be a title, try to find by title
-        if not node and isinstance(node_id, str) and not node_id.startswith("node_"):
-            node = self.get_node_by_title(node_id)
+        node = self._find_node(node_id)
             
         if not node:
             return {'status': 'error', 'message': f'Node not found: {node_id}'}
@@ -539,7 +937,8 @@ class AgentInterface:
         node_data = self._get_node_data_dict(node, depth if include_children else 0)
         return {'status': 'success', 'data': node_data}
     
-    def _action_search_nodes(self, search_text, title_only=False, exact_match=False, return_nodes=False):
+    def _action_search_nodes(self, search_text, title_only=False, exact_match=False, return_nodes=False,
+                             limit=None):
         """Search for nodes containing specific text.
         
         Args:
@@ -547,41 +946,39 @@ class AgentInterface:
             title_only: If True, only search in node titles
             exact_match: If True, requires exact match rather than word-by-word
             return_nodes: If True, returns full node data rather than just metadata
+            limit: Maximum number of results to return (None for all)
             
         Returns:
             Dictionary with search results
         """
         results = []
-        words = search_text.split()
+        # wordSearch lowercases only the node data, so lowercase the words
+        # once here for a case-insensitive match
+        words = tuple(search_text.lower().split())
         
         # Search in entire tree
         for node in self.tree_structure.nodeDict.values():
-            # First handle exact match case if requested
             if exact_match:
-                title = node.title()
-                if (title_only and title == search_text) or \
-                   (not title_only and any(value == search_text for value in node.data.values())):
-                    if return_nodes:
-                        results.append(self._get_node_data_dict(node, depth=1))
-                    else:
-                        results.append({
-                            'id': str(node.uId),
-                            'title': title,
-                            'matches': ['exact_match']
-                        })
-                    continue
-            
-            # Otherwise do regular word search
-            matches = node.wordSearch(words, title_only)
-            if matches:
-                if return_nodes:
-                    results.append(self._get_node_data_dict(node, depth=1))
+                if title_only:
+                    matches = (['exact_match'] if self._node_title(node) == search_text
+                               else None)
                 else:
-                    results.append({
-                        'id': str(node.uId),
-                        'title': node.title(),
-                        'matches': matches
-                    })
+                    matches = ['exact_match'] if search_text in node.data.values() else None
+            else:
+                matches = node.wordSearch(words, title_only)
+            if not matches:
+                continue
+                
+            if return_nodes:
+                results.append(self._get_node_data_dict(node, depth=1))
+            else:
+                results.append({
+                    'id': node.uId,
+                    'title': self._node_title(node),
+                    'matches': matches
+                })
+            if limit and len(results) >= limit:
+                break
                 
         return {
             'status': 'success', 
@@ -625,9 +1022,6 @@ class AgentInterface:
             return {'status': 'error', 'message': f'Format type "{name}" already exists'}
         
         try:
-            # Import required modules
-            import nodeformat
-            
             # Create a new node format in the tree structure's format collection
             new_format = nodeformat.NodeFormat(name, self.tree_structure.treeFormats, addDefaultField=True)
             
@@ -666,6 +1060,7 @@ class AgentInterface:
             
             # Update format references
             self.tree_structure.treeFormats.updateDerivedRefs()
+            self._mark_tree_changed()
             
             # Create title line and output lines based on fields
             title_parts = []
@@ -687,7 +1082,7 @@ class AgentInterface:
                                 treeformats.TreeFormats())
             
             # Update any UI components
-            self.local_control.updateAll(True)
+            self._update_views()
             
             return {
                 'status': 'success', 
@@ -695,7 +1090,6 @@ class AgentInterface:
             }
             
         except Exception as e:
-            import traceback
             print(f"Error creating format type: {str(e)}")
             print(traceback.format_exc())
             return {'status': 'error', 'message': f'Failed to create format type: {str(e)}'}
@@ -719,24 +1113,103 @@ class AgentInterface:
                 'format_types': self._action_get_format_types()['formats']
             }
             
-        # Get all root nodes and their data
-        root_nodes = []
-        for node in self.tree_structure.childList:
-            root_nodes.append(self._get_node_data_dict(node, max_depth))
-            
-        # If there's only one root node, return it directly
-        if len(root_nodes) == 1:
-            tree_data = root_nodes[0]
-        else:
-            # If there are multiple root nodes, return them all in a list
-            tree_data = {'root_nodes': root_nodes}
+        # Reuse the last result while the tree is unchanged, both by the
+        # agent and in the main window (see refresh_tree_caches)
+        cache_key, tree_data = self._tree_structure_cache
+        if cache_key != (self._mut_counter, max_depth):
+            # Get all root nodes and their data
+            root_nodes = []
+            for node in self.tree_structure.childList:
+                root_nodes.append(self._get_node_data_dict(node, max_depth))
+                
+            # If there's only one root node, return it directly
+            if len(root_nodes) == 1:
+                tree_data = root_nodes[0]
+            else:
+                # If there are multiple root nodes, return them all in a list
+                tree_data = {'root_nodes': root_nodes}
+            self._tree_structure_cache = ((self._mut_counter, max_depth), tree_data)
         
+        # Format types are edited in place by the configuration dialog
+        # without a tree change, so they are always read fresh
         return {
             'status': 'success',
             'tree': tree_data,
             'format_types': self._action_get_format_types()['formats']
         }
         
+    def _action_get_tree_page(self, node_id=None, cursor='', page_size=200, max_depth=2):
+        """Get one page of the tree, a run of sibling subtrees at a time.
+        
+        Args:
+            node_id: ID or title of the node whose children are paged.
+                     If None, pages the top-level nodes.
+            cursor: The next_cursor value from a previous page
+            page_size: Approximate maximum number of nodes in the page
+            max_depth: Levels of children to include below each entry
+            
+        Returns:
+            Dictionary with the page's nodes and the cursor for the next page
+        """
+        if cursor:
+            try:
+                parent_uid, start = json.loads(base64.urlsafe_b64decode(cursor))
+            except (ValueError, TypeError):
+                return {'status': 'error', 'message': f'Invalid cursor: {cursor}'}
+            parent = (self.tree_structure.nodeDict.get(parent_uid)
+                      if parent_uid else None)
+            if parent_uid and not parent:
+                return {'status': 'error', 'message': 'Cursor node no longer exists'}
+        else:
+            start = 0
+            parent = None
+            if node_id is not None:
+                parent = self._find_node(node_id)
+                if not parent:
+                    return {'status': 'error', 'message': f'Node not found: {node_id}'}
+        siblings = parent.childList if parent else self.tree_structure.childList
+        
+        nodes = []
+        node_count = 0
+        index = start
+        while index < len(siblings) and (not nodes or node_count < page_size):
+            child = siblings[index]
+            nodes.append(self._get_node_data_dict(child, max_depth))
+            node_count += self._count_subtree_nodes(child, max_depth)
+            index += 1
+            
+        next_cursor = None
+        if index < len(siblings):
+            next_cursor = base64.urlsafe_b64encode(json.dumps(
+                [parent.uId if parent else None, index]).encode()).decode()
+        return {
+            'status': 'success',
+            'parent_id': parent.uId if parent else None,
+            'nodes': nodes,
+            'count': len(nodes),
+            'next_cursor': next_cursor
+        }
+    
+    def _count_subtree_nodes(self, node, depth):
+        """Count a node and its descendants down to the given depth.
+        
+        Args:
+            node: The subtree's top node
+            depth: How many levels of children to count
+            
+        Returns:
+            The number of nodes
+        """
+        count = 0
+        stack = [(node, depth)]
+        while stack:
+            current, current_depth = stack.pop()
+            count += 1
+            if current_depth > 0:
+                stack.extend((child, current_depth - 1)
+                             for child in current.childList)
+        return count
+        
     def _action_get_node_path(self, node_id=None):
         """Get the path from root to the specified node.
         
@@ -747,33 +1220,29 @@ class AgentInterface:
             Dictionary with path information
         """
         # Find node - try by ID first, then by title
-        node = self._get_node_by_id(node_id)
-        if not node and isinstance(node_id, str) and not node_id.startswith("node_"):
-            node = self.get_node_by_title(node_id)
+        node = self._find_node(node_id)
             
         if not node:
             return {'status': 'error', 'message': f'Node not found: {node_id}'}
         
-        # Build path from root to this node
+        # Build path from this node up to the root, reversed at the end
         path = []
         current = node
         
         # Go up the tree to find ancestors
         while current and current.parent:  # Stop when we reach a root node
             parent = current.parent
-            if not parent:
-                break
-                
+            
             # Find position of this node in parent's children
             try:
                 position = parent.childList.index(current)
             except ValueError:
                 position = -1
                 
-            path.insert(0, {
-                'id': str(current.uId),
-                'title': current.title(),
-                'parent_id': str(parent.uId),
+            path.append({
+                'id': current.uId,
+                'title': self._node_title(current),
+                'parent_id': parent.uId,
                 'position': position
             })
             
@@ -781,19 +1250,20 @@ class AgentInterface:
             
         # Add first root node if the current node is a top-level node
         if current in self.tree_structure.childList and node != current:
-            path.insert(0, {
-                'id': str(current.uId),
-                'title': current.title(),
+            path.append({
+                'id': current.uId,
+                'title': self._node_title(current),
                 'parent_id': None,
                 'position': 0
             })
+        path.reverse()
             
         return {
             'status': 'success',
             'path': path,
             'node': {
-                'id': str(node.uId),
-                'title': node.title()
+                'id': node.uId,
+                'title': self._node_title(node)
             }
         }
         
@@ -808,32 +1278,27 @@ class AgentInterface:
             Dictionary with children information
         """
         # Find node - try by ID first, then by title
-        node = self._get_node_by_id(node_id)
-        if not node and isinstance(node_id, str) and not node_id.startswith("node_"):
-            node = self.get_node_by_title(node_id)
+        node = self._find_node(node_id)
             
         if not node:
             return {'status': 'error', 'message': f'Node not found: {node_id}'}
             
-        # Get children
-        children = []
-        for index, child in enumerate(node.childList):
-            if include_data:
-                child_data = self._get_node_data_dict(child, depth=0)
-                child_data['position'] = index
-                children.append(child_data)
-            else:
-                children.append({
-                    'id': str(child.uId),
-                    'title': child.title(),
-                    'position': index
-                })
+        # Get children, choosing the entry format once for the whole list
+        if include_data:
+            get_node_data = self._get_node_data_dict
+            children = [dict(get_node_data(child, depth=0), position=index)
+                        for index, child in enumerate(node.childList)]
+        else:
+            node_title = self._node_title
+            children = [{'id': child.uId, 'title': node_title(child),
+                         'position': index}
+                        for index, child in enumerate(node.childList)]
                 
         return {
             'status': 'success',
             'parent': {
-                'id': str(node.uId),
-                'title': node.title()
+                'id': node.uId,
+                'title': self._node_title(node)
             },
             'children': children,
             'count': len(children)
@@ -850,9 +1315,7 @@ class AgentInterface:
             Dictionary with sibling information
         """
         # Find node - try by ID first, then by title
-        node = self._get_node_by_id(node_id)
-        if not node and isinstance(node_id, str) and not node_id.startswith("node_"):
-            node = self.get_node_by_title(node_id)
+        node = self._find_node(node_id)
             
         if not node:
             return {'status': 'error', 'message': f'Node not found: {node_id}'}
@@ -866,36 +1329,33 @@ class AgentInterface:
                 'siblings': []
             }
             
-        # Get siblings
-        siblings = []
-        current_index = -1
-        
-        for index, sibling in enumerate(parent.childList):
-            # Track the current node's position
-            if sibling == node:
-                current_index = index
-                continue
-                
-            if include_data:
-                sibling_data = self._get_node_data_dict(sibling, depth=0)
-                sibling_data['position'] = index
-                siblings.append(sibling_data)
-            else:
-                siblings.append({
-                    'id': str(sibling.uId),
-                    'title': sibling.title(),
-                    'position': index
-                })
+        # Get siblings, skipping the node itself
+        child_list = parent.childList
+        try:
+            current_index = child_list.index(node)
+        except ValueError:
+            current_index = -1
+        if include_data:
+            get_node_data = self._get_node_data_dict
+            siblings = [dict(get_node_data(sibling, depth=0), position=index)
+                        for index, sibling in enumerate(child_list)
+                        if sibling is not node]
+        else:
+            node_title = self._node_title
+            siblings = [{'id': sibling.uId, 'title': node_title(sibling),
+                         'position': index}
+                        for index, sibling in enumerate(child_list)
+                        if sibling is not node]
                 
         return {
             'status': 'success',
             'parent': {
-                'id': str(parent.uId),
-                'title': parent.title()
+                'id': parent.uId,
+                'title': self._node_title(parent)
             },
             'node': {
-                'id': str(node.uId),
-                'title': node.title(),
+                'id': node.uId,
+                'title': self._node_title(node),
                 'position': current_index
             },
             'siblings': siblings,
@@ -912,14 +1372,8 @@ class AgentInterface:
         Returns:
             Dictionary with node information if found
         """
+        # Exact match first, then the case-insensitive index
         node = self.get_node_by_title(title)
-        
-        if not node:
-            # Try case-insensitive search as fallback
-            for node_id, n in self.tree_structure.nodeDict.items():
-                if n.title().lower() == title.lower():
-                    node = n
-                    break
                     
         if not node:
             return {
@@ -938,12 +1392,27 @@ class AgentInterface:
             return {
                 'status': 'success',
                 'node': {
-                    'id': str(node.uId),
-                    'title': node.title(),
+                    'id': node.uId,
+                    'title': self._node_title(node),
                     'format_type': node.formatRef.name
                 }
             }
     
+    def _find_node(self, node_id=None, id_prefix='node_'):
+        """Find a node by ID, falling back to a title lookup.
+        
+        Args:
+            node_id: ID or title of the node. If None, gets selected node.
+            id_prefix: Prefix of placeholder IDs that are never titles
+            
+        Returns:
+            TreeNode instance or None if not found
+        """
+        node = self._get_node_by_id(node_id)
+        if not node and isinstance(node_id, str) and not node_id.startswith(id_prefix):
+            node = self.get_node_by_title(node_id)
+        return node
+    
     def _get_node_by_id(self, node_id=None):
         """Helper to get a node by ID or selected node.
         
@@ -954,24 +1423,21 @@ class AgentInterface:
             TreeNode instance or None if not found
         """
         if node_id:
-            # Try to find by ID
+            node_dict = self.tree_structure.nodeDict
+            # Node IDs are stored as hex UUID strings
             try:
-                # Try parsing as UUID if it looks like a UUID
-                if isinstance(node_id, str) and len(node_id) > 30 and '-' in node_id:
-                    uid = uuid.UUID(node_id)
-                    return self.tree_structure.nodeDict.get(uid)
-                # If it's already a UUID object
-                elif isinstance(node_id, uuid.UUID):
-                    return self.tree_structure.nodeDict.get(node_id)
-                # String but not a UUID - try iterating through nodes to find match
-                else:
-                    for node_uid, node in self.tree_structure.nodeDict.items():
-                        if str(node_uid) == node_id:
-                            return node
-                    return None
-            except (ValueError, TypeError):
-                # Not a valid UUID, return None
+                node = node_dict.get(node_id)
+            except TypeError:
+                # Unhashable value, can't be an ID
+                return None
+            if node is not None:
+                return node
+            # Also accept UUID objects and hyphenated UUID strings
+            try:
+                uid = node_id if isinstance(node_id, uuid.UUID) else uuid.UUID(node_id)
+            except (ValueError, TypeError, AttributeError):
                 return None
+            return node_dict.get(uid.hex)
         else:
             # Get selected node
             selection = self.selection
@@ -985,68 +1451,17 @@ class AgentInterface:
             return self.tree_structure.childList[0]
         return None
     
-    def process_agent_request(self, prompt):
-        """Process a request from the user through the Anthropic API.
+    def _get_sys_prompt(self):
+        """Return the system prompt text, reading SYS_PROMPT.md on first use.
         
-        Args:
-            prompt: User's request text
-            
         Returns:
-            Dictionary with response from the agent
+            The system prompt text
         """
-        if not self.client:
-            return {
-                'status': 'error',
-                'message': 'Anthropic API client not initialized. Please set API key.'
-            }
-        
-        # Add user message to history
-        self.message_history.append({"role": "user", "content": prompt})
-            
-        # Get current tree context
-        tree_json = self.get_tree_json()
-        format_types = self._action_get_format_types()['formats']
-        
-        # Make sure data is JSON serializable
-        def sanitize_for_json(obj):
-            if isinstance(obj, dict):
-                return {k: sanitize_for_json(v) for k, v in obj.items()}
-            elif isinstance(obj, list):
-                return [sanitize_for_json(item) for item in obj]
-            elif isinstance(obj, (int, float, str, bool)) or obj is None:
-                return obj
-            else:
-                return str(obj)
-        
-        # Create conversation context from message history
-        conversation_context = ""
-        if len(self.message_history) > 1:
-            conversation_context += "Recent conversation history:\n"
-            # Include up to 10 recent messages
-            for msg in self.message_history[-10:]:
-                role_prefix = "USER" if msg["role"] == "user" else "ASSISTANT"
-                conversation_context += f"[{role_prefix}] {msg['content']}\n"
-            
-            # Include recent action results
-            if self.action_results:
-                conversation_context += "\nRecent action results:\n"
-                for action, result in self.action_results.items():
-                    status = result.get('status', '')
-                    message = result.get('message', '')
-                    conversation_context += f"[ACTION] {action}: {status} - {message}\n"
-                
-            # Include last created node context
-            if self.last_created_node_id:
-                node_info = self._action_get_node(self.last_created_node_id)
-                if node_info['status'] == 'success':
-                    conversation_context += f"\nLast created/modified node:\n"
-                    conversation_context += f"ID: {self.last_created_node_id}\n"
-                    conversation_context += f"Title: {node_info['data'].get('title', '')}\n"
-                
+        if self._sys_prompt_cached is not None:
+            return self._sys_prompt_cached
         # Load system prompt from SYS_PROMPT.md
-        sys_prompt_path = pathlib.Path(__file__).parent / "SYS_PROMPT.md"
         try:
-            with open(sys_prompt_path, 'r', encoding='utf-8') as f:
+            with open(_SYS_PROMPT_PATH, 'r', encoding='utf-8') as f:
                 sys_prompt_content = f.read()
         except FileNotFoundError:
             # Fallback to embedded system prompt if file not found
@@ -1080,18 +1495,116 @@ class AgentInterface:
             }
             ```
             """
+        self._sys_prompt_cached = sys_prompt_content
+        return sys_prompt_content
+    
+    def _get_format_types_json(self, format_types):
+        """Return the format types as indented JSON, reusing the last result.
+        
+        Formats can be edited in place from the configuration dialog, so the
+        cached text is reused only while the format data compares equal.
+        
+        Args:
+            format_types: The 'formats' dictionary from get_format_types
+            
+        Returns:
+            JSON string of the format types
+        """
+        if format_types != self._format_types_cached:
+            self._format_types_json_cached = json.dumps(format_types, indent=2,
+                                                        default=str)
+            self._format_types_cached = format_types
+        return self._format_types_json_cached
+    
+    def process_agent_request(self, prompt):
+        """Process a request from the user through the Anthropic API.
         
-        # Create system message using concatenation instead of f-strings
-        system_message = """
-        """ + sys_prompt_content + """
+        This blocks until the response arrives; AgentDialog instead waits
+        for the API in an AgentRequestThread.
+        
+        Args:
+            prompt: User's request text
+            
+        Returns:
+            Dictionary with response from the agent
+        """
+        request = self.prepare_agent_request(prompt)
+        if request['status'] != 'success':
+            return request
+        try:
+            message_content = self._get_completion(request['system'],
+                                                   request['messages'])
+        except Exception as e:
+            return self._request_failed(e)
+        return self.handle_agent_response(message_content)
+    
+    def prepare_agent_request(self, prompt):
+        """Record a user prompt and build the API request for it.
+        
+        Args:
+            prompt: User's request text
+            
+        Returns:
+            Dictionary with the 'system' message and 'messages' list for
+            the API, or an error status
+        """
+        if not self.client:
+            return {
+                'status': 'error',
+                'message': 'Anthropic API client not initialized. Please set API key.'
+            }
+        
+        # Add user message to history
+        self.message_history.append({"role": "user", "content": prompt})
+        self._cancel_requested = False
+            
+        # Get current tree context
+        tree_dict = self.get_tree_dict()
+        tree_json = json.dumps(tree_dict, indent=2, default=str)
+        format_types = self._action_get_format_types()['formats']
+        
+        # Create conversation context from message history
+        context_lines = []
+        if len(self.message_history) > 1:
+            context_lines.append("Recent conversation history:\n")
+            # Include up to 10 recent messages
+            history_len = len(self.message_history)
+            for msg in itertools.islice(self.message_history,
+                                        max(0, history_len - 10), history_len):
+                role_prefix = "USER" if msg["role"] == "user" else "ASSISTANT"
+                context_lines.append(f"[{role_prefix}] {msg['content']}\n")
+            
+            # Include recent action results
+            if self.action_results:
+                context_lines.append("\nRecent action results:\n")
+                for action, result in self.action_results.items():
+                    status = result.get('status', '')
+                    message = result.get('message', '')
+                    context_lines.append(f"[ACTION] {action}: {status} - {message}\n")
+                
+            # Include last created node context
+            if self.last_created_node_id:
+                # Only the title is needed, so skip building the node's data dict
+                last_node = self._get_node_by_id(self.last_created_node_id)
+                if last_node is not None:
+                    context_lines.append(f"\nLast created/modified node:\n"
+                                         f"ID: {self.last_created_node_id}\n"
+                                         f"Title: {self._node_title(last_node)}\n")
+        conversation_context = "".join(context_lines)
+                
+        sys_prompt_content = self._get_sys_prompt()
+        
+        # Create system message by joining the parts in one pass
+        system_message = "".join(("""
+        """, sys_prompt_content, """
         
         Current tree structure:
-        """ + tree_json + """
+        """, tree_json, """
         
         Available node format types:
-        """ + json.dumps(sanitize_for_json(format_types), indent=2) + """
+        """, self._get_format_types_json(format_types), """
         
-        """ + conversation_context + """
+        """, conversation_context, """
         
         Respond with a JSON object that includes:
         - A friendly response to the user explaining what you will do or have done
@@ -1103,103 +1616,70 @@ class AgentInterface:
         
         If you need more information before performing an action, ask the user.
         If no action is needed, just respond with a helpful message.
-        """
+        """))
+        
+        # Send up to 10 most recent messages, ending with the current one.
+        # History entries are already role/content dicts and are never modified.
+        history_len = len(self.message_history)
+        api_messages = list(itertools.islice(self.message_history,
+                                             max(0, history_len - 10), history_len))
+        
+        # Keep what we're sending for debugging; it is formatted only when viewed
+        # Avoid including the full system message which might have format specifiers
+        self._last_log_data = {
+            "messages": api_messages,
+            "format_types": format_types,
+            "last_created_node": self.last_created_node_id,
+            "tree_structure": tree_dict
+        }
         
-        try:
-            # Prepare messages for API with history
-            api_messages = []
-            
-            # Include up to 10 most recent messages, but skip the current one (added at the end)
-            if len(self.message_history) > 1:
-                for msg in self.message_history[:-1][-9:]:  # Last 9 messages excluding current
-                    api_messages.append({"role": msg["role"], "content": msg["content"]})
-            
-            # Add current message
-            api_messages.append({"role": "user", "content": prompt})
-            
-            # Log what we're sending
-            try:
-                # Avoid including the full system message which might have format specifiers
-                log_data = {
-                    "messages": api_messages,
-                    "format_types": sanitize_for_json(format_types),
-                    "last_created_node": self.last_created_node_id
-                }
-                
-                # Try to include tree structure if valid
-                try:
-                    if isinstance(tree_json, str):
-                        log_data["tree_structure"] = json.loads(tree_json)
-                except:
-                    log_data["tree_structure"] = "Error parsing tree structure"
-                
-                # Store log data for debugging
-                self.last_api_request_log = json.dumps(log_data, indent=2)
-            except Exception as e:
-                self.last_api_request_log = f"Error creating log data: {str(e)}"
-            
-            # Send request to Anthropic API
-            response = self.client.messages.create(
-                model="claude-3-opus-20240229",
-                max_tokens=1024,
-                temperature=0,
-                system=system_message,
-                messages=api_messages
-            )
-            
-            # Parse response to extract action
-            message_content = response.content[0].text
+        return {
+            'status': 'success',
+            'system': system_message,
+            'messages': api_messages
+        }
+    
+    def handle_agent_response(self, message_content):
+        """Parse the agent's response text and execute the requested actions.
+        
+        Args:
+            message_content: Response text from the API
             
+        Returns:
+            Dictionary with response from the agent
+        """
+        try:
             # Try to parse JSON from the response
             try:
-                # Check if the message contains JSON wrapped in ``` or not
-                if "```json" in message_content:
-                    parts = message_content.split("```json", 1)
-                    if len(parts) > 1:
-                        json_blocks = parts[1].split("```", 1)
-                        if len(json_blocks) > 0:
-                            json_str = json_blocks[0].strip()
-                            action_data = json.loads(json_str)
-                elif "```" in message_content:
-                    parts = message_content.split("```", 1)
-                    if len(parts) > 1:
-                        json_blocks = parts[1].split("```", 1)
-                        if len(json_blocks) > 0:
-                            json_str = json_blocks[0].strip()
-                            action_data = json.loads(json_str)
-                else:
-                    # Try to parse the entire message as JSON
-                    action_data = json.loads(message_content)
+                # Use the JSON in a ``` fence if there is one, else the whole message
+                match = _FENCE_RE.search(message_content)
+                json_str = match.group(1) if match else message_content
+                action_data = json.loads(json_str.strip())
                 
                 # Handle case where agent wants to perform multiple actions in sequence
                 if 'actions' in action_data and isinstance(action_data['actions'], list):
-                    # Execute each action in the list
-                    action_results = []
+                    # Execute all valid actions with a single view update
+                    action_items = [item for item in action_data['actions']
+                                    if 'action' in item and 'parameters' in item]
+                    action_results = self.batch_execute(action_items)
                     
-                    for action_item in action_data['actions']:
-                        if 'action' in action_item and 'parameters' in action_item:
-                            action_result = self.execute_action(
-                                action_item['action'], 
-                                **action_item['parameters']
-                            )
-                            
-                            # Store result
-                            action_item['action_result'] = action_result
-                            action_results.append(action_result)
+                    for action_item, action_result in zip(action_items, action_results):
+                        # Store result
+                        action_item['action_result'] = action_result
+                        
+                        # Track node creation
+                        if action_item['action'] == 'add_node' and action_result['status'] == 'success':
+                            self.last_created_node_id = action_result.get('node_id')
                             
-                            # Track node creation
-                            if action_item['action'] == 'add_node' and action_result['status'] == 'success':
-                                self.last_created_node_id = action_result.get('node_id')
-                                
-                            # Store in context
-                            self.action_results[action_item['action']] = action_result
+                        # Store in context
+                        self.action_results[action_item['action']] = action_result
                             
                     # Add all results to response
                     action_data['action_results'] = action_results
                     
                     # Print detailed execution information
                     print("AUTO-EXECUTING MULTIPLE ACTIONS:")
-                    for i, (action_item, result) in enumerate(zip(action_data['actions'], action_results)):
+                    for i, (action_item, result) in enumerate(zip(action_items, action_results)):
                         action_name = action_item.get('action', 'unknown')
                         status = result.get('status', 'unknown')
                         message = result.get('message', 'No message')
@@ -1248,13 +1728,96 @@ class AgentInterface:
                 }
                 
         except Exception as e:
-            error_message = f'Error processing request: {str(e)}'
-            # Store error in history for context
-            self.message_history.append({"role": "assistant", "content": f"[ERROR] {error_message}"})
-            return {
-                'status': 'error',
-                'message': error_message
-            }
+            return self._request_failed(e)
+    
+    def _request_failed(self, error):
+        """Record a failed request in the history and return its error result.
+        
+        Args:
+            error: The exception or error text
+            
+        Returns:
+            Dictionary with the error status and message
+        """
+        error_message = f'Error processing request: {str(error)}'
+        # Store error in history for context
+        self.message_history.append({"role": "assistant", "content": f"[ERROR] {error_message}"})
+        return {
+            'status': 'error',
+            'message': error_message
+        }
+
+
+def _format_structure_text(top_nodes):
+    """Format node data dicts as an indented list of titles and IDs.
+    
+    Args:
+        top_nodes: List of top-level node data dictionaries
+        
+    Returns:
+        The structure text, one line per node
+    """
+    parts = []
+    stack = [(node, 0) for node in reversed(top_nodes)]
+    while stack:
+        node, level = stack.pop()
+        parts.append(f"{'  ' * level}- {node.get('title', 'Untitled')} "
+                     f"(ID: {node.get('id', 'unknown')})\n")
+        stack.extend((child, level + 1)
+                     for child in reversed(node.get('children', [])))
+    return ''.join(parts)
+
+
+class StructureTextThread(QThread):
+    """Worker thread that formats the tree structure text."""
+    
+    textReady = pyqtSignal(str)
+    
+    def __init__(self, top_nodes, parent=None):
+        """Initialize the worker.
+        
+        Args:
+            top_nodes: List of top-level node data dictionaries, not modified
+            parent: Parent object
+        """
+        super().__init__(parent)
+        self.top_nodes = top_nodes
+        
+    def run(self):
+        """Format the structure and emit the text."""
+        self.textReady.emit(_format_structure_text(self.top_nodes))
+
+
+class AgentRequestThread(QThread):
+    """Worker thread that waits for the agent's API response."""
+    
+    responseReady = pyqtSignal(str)
+    requestFailed = pyqtSignal(str)
+    
+    def __init__(self, agent_interface, request, parent=None):
+        """Initialize the worker for a prepared request.
+        
+        Args:
+            agent_interface: The AgentInterface that sends the request
+            request: Result of AgentInterface.prepare_agent_request
+            parent: Parent object
+        """
+        super().__init__(parent)
+        self.agent_interface = agent_interface
+        self.request = request
+        
+    def run(self):
+        """Send the request and emit the response text or the error."""
+        try:
+            message_content = self.agent_interface._get_completion(
+                self.request['system'], self.request['messages'])
+        except asyncio.CancelledError:
+            # Stopped because the dialog closed, so there is nobody to tell
+            return
+        except Exception as e:
+            self.requestFailed.emit(str(e))
+            return
+        self.responseReady.emit(message_content)
 
 
 class AgentDialog(QDialog):
@@ -1262,6 +1825,12 @@ class AgentDialog(QDialog):
     
     dialogShown = pyqtSignal(bool)
     
+    # TreeStructure attributes shown by dump_tree_info, besides the
+    # nodes and formats that are listed separately
+    _DUMP_ATTRIBUTES = ('uId', 'data', 'formatRef', 'spotRefs', 'tmpChildRefs',
+                        'undoList', 'redoList', 'configDialogFormats',
+                        'mathZeroBlanks', 'childRefErrorNodes', 'fileInfoNode')
+    
     def __init__(self, local_control, parent=None):
         """Initialize the agent dialog.
         
@@ -1272,10 +1841,25 @@ class AgentDialog(QDialog):
         super().__init__(parent)
         self.local_control = local_control
         self.agent_interface = AgentInterface(local_control)
+        self.agent_interface.chunkReceived.connect(self._on_agent_chunk)
+        self._received_chars = 0
+        self._request_thread = None
+        self._last_assistant_message = None
+        # List of held log entries while logging a batch, otherwise None
+        self._log_buffer = None
+        # Top-level node data and the structure text rendered from it, and
+        # the threads still formatting structure text
+        self._structure_cache = ([], '')
+        self._structure_threads = []
         
         self.setWindowTitle(_('AI Assistant'))
         self.resize(800, 600)
         self.setup_ui()
+        
+        # Windows are not closed on quit, so stop any request then as well
+        app = QApplication.instance()
+        if app:
+            app.aboutToQuit.connect(self._stop_workers)
     
     def setup_ui(self):
         """Set up the user interface components."""
@@ -1284,6 +1868,9 @@ class AgentDialog(QDialog):
         # Log view for agent responses and system messages
         self.log_view = QTextEdit()
         self.log_view.setReadOnly(True)
+        self.log_view.setUndoRedoEnabled(False)
+        # Drop the oldest lines once the log gets long
+        self.log_view.document().setMaximumBlockCount(5000)
         
         # Input area for user prompts
         input_layout = QHBoxLayout()
@@ -1359,33 +1946,68 @@ class AgentDialog(QDialog):
         if not self.agent_interface._get_api_key():
             self.log_system_message(_("Please configure your Anthropic API key to use the assistant."), "error")
     
-    def log_system_message(self, message, level="info"):
-        """Add a system message to the log.
+    # Label colors for the log view
+    _LOG_COLORS = {
+        'error': '#c80000',
+        'warning': '#c89600',
+        'info': '#646464',
+        'user': '#0064c8',
+        'agent': '#009600',
+        'action': '#649664'
+    }
+    
+    def _log_entry_html(self, role, message, color):
+        """Return the HTML for one log entry.
         
         Args:
+            role: Label shown before the message
             message: Message text
-            level: Message level (info, warning, error)
+            color: Label color as an HTML color string
+            
+        Returns:
+            HTML string with the escaped message
+        """
+        # Keep the spacing and indentation of JSON and code in the message
+        text = html.escape(str(message)).replace('\n', '<br>')
+        return (f'<span style="color:{color}">[{role}]</span> '
+                f'<span style="white-space:pre-wrap">{text}</span>')
+    
+    def _log_html(self, role, message, color):
+        """Append one entry to the end of the log.
+        
+        Args:
+            role: Label shown before the message
+            message: Message text
+            color: Label color as an HTML color string
         """
-        cursor = self.log_view.textCursor()
-        cursor.movePosition(QTextCursor.End)
+        self._append_log(self._log_entry_html(role, message, color))
+    
+    def _append_log(self, entry_html):
+        """Append HTML to the log, or hold it while a batch is being logged.
         
-        # Format based on level
-        format = QTextCharFormat()
-        if level == "error":
-            format.setForeground(QColor(200, 0, 0))
-        elif level == "warning":
-            format.setForeground(QColor(200, 150, 0))
+        Args:
+            entry_html: HTML for one or more log entries
+        """
+        if self._log_buffer is not None:
+            self._log_buffer.append(entry_html)
         else:
-            format.setForeground(QColor(100, 100, 100))
-            
-        # Add timestamp and level
-        self.log_view.setTextCursor(cursor)
-        cursor.insertText(f"[SYSTEM] ", format)
-        cursor.insertText(f"{message}\n")
+            self.log_view.append(entry_html)
+    
+    def _flush_log(self):
+        """Append any held log entries in one block and stop buffering."""
+        buffered, self._log_buffer = self._log_buffer, None
+        if buffered:
+            self.log_view.append('<br>'.join(buffered))
+    
+    def log_system_message(self, message, level="info"):
+        """Add a system message to the log.
         
-        # Scroll to bottom
-        cursor.movePosition(QTextCursor.End)
-        self.log_view.setTextCursor(cursor)
+        Args:
+            message: Message text
+            level: Message level (info, warning, error)
+        """
+        color = self._LOG_COLORS.get(level, self._LOG_COLORS['info'])
+        self._log_html('SYSTEM', message, color)
     
     def log_user_message(self, message):
         """Add a user message to the log.
@@ -1393,18 +2015,7 @@ class AgentDialog(QDialog):
         Args:
             message: Message text
         """
-        cursor = self.log_view.textCursor()
-        cursor.movePosition(QTextCursor.End)
-        
-        format = QTextCharFormat()
-        format.setForeground(QColor(0, 100, 200))
-        
-        self.log_view.setTextCursor(cursor)
-        cursor.insertText(f"[USER] ", format)
-        cursor.insertText(f"{message}\n")
-        
-        cursor.movePosition(QTextCursor.End)
-        self.log_view.setTextCursor(cursor)
+        self._log_html('USER', message, self._LOG_COLORS['user'])
     
     def log_agent_message(self, message):
         """Add an agent message to the log.
@@ -1412,18 +2023,22 @@ class AgentDialog(QDialog):
         Args:
             message: Message text
         """
-        cursor = self.log_view.textCursor()
-        cursor.movePosition(QTextCursor.End)
-        
-        format = QTextCharFormat()
-        format.setForeground(QColor(0, 150, 0))
-        
-        self.log_view.setTextCursor(cursor)
-        cursor.insertText(f"[ASSISTANT] ", format)
-        cursor.insertText(f"{message}\n")
+        self._log_html('ASSISTANT', message, self._LOG_COLORS['agent'])
+        self._last_assistant_message = str(message)
+    
+    def _action_result_html(self, result):
+        """Return the log entry HTML for an action result.
         
-        cursor.movePosition(QTextCursor.End)
-        self.log_view.setTextCursor(cursor)
+        Args:
+            result: Result data
+            
+        Returns:
+            HTML string for the result message
+        """
+        color = (self._LOG_COLORS['action'] if result.get('status') == 'success'
+                 else self._LOG_COLORS['error'])
+        return self._log_entry_html('ACTION', result.get('message', str(result)),
+                                    color)
     
     def log_action_result(self, result):
         """Add an action result to the log.
@@ -1431,29 +2046,23 @@ class AgentDialog(QDialog):
         Args:
             result: Result data
         """
-        level = "info" if result.get('status') == 'success' else "error"
-        message = result.get('message', str(result))
-        
-        cursor = self.log_view.textCursor()
-        cursor.movePosition(QTextCursor.End)
-        
-        format = QTextCharFormat()
-        if level == "error":
-            format.setForeground(QColor(200, 0, 0))
-        else:
-            format.setForeground(QColor(100, 150, 100))
-            
-        self.log_view.setTextCursor(cursor)
-        cursor.insertText(f"[ACTION] ", format)
-        cursor.insertText(f"{message}\n")
+        self._append_log(self._action_result_html(result))
+    
+    def log_action_results(self, results):
+        """Add several action results to the log in a single append.
         
-        cursor.movePosition(QTextCursor.End)
-        self.log_view.setTextCursor(cursor)
+        Args:
+            results: List of result data
+        """
+        if results:
+            self._append_log('<br>'.join(self._action_result_html(result)
+                                         for result in results))
     
     def send_prompt(self):
         """Send the current prompt to the agent."""
         prompt = self.prompt_input.text().strip()
-        if not prompt:
+        if not prompt or self._request_thread is not None:
+            # Nothing to send, or still waiting for the previous response
             return
             
         # Log user message
@@ -1469,15 +2078,37 @@ class AgentDialog(QDialog):
             
         # Update UI state
         self.send_button.setEnabled(False)
+        self.progress_bar.setRange(0, 0)
         self.progress_bar.setVisible(True)
         self.status_label.setText(_("Processing request..."))
+        self._received_chars = 0
         
-        # Process request in background (simplified - would use QThread in full implementation)
-        QApplication.processEvents()
+        try:
+            request = self.agent_interface.prepare_agent_request(prompt)
+        except Exception as e:
+            request = {'status': 'error', 'message': f"Error: {str(e)}"}
+        if request['status'] != 'success':
+            self.log_system_message(request['message'], "error")
+            self._restore_ui_state()
+            return
+            
+        # Wait for the API response in a worker thread to keep the UI responsive
+        self._request_thread = AgentRequestThread(self.agent_interface, request, self)
+        self._request_thread.responseReady.connect(self._on_agent_response)
+        self._request_thread.requestFailed.connect(self._on_agent_failure)
+        self._request_thread.finished.connect(self._request_thread.deleteLater)
+        self._request_thread.start()
+    
+    def _on_agent_response(self, message_content):
+        """Execute and log the agent's response once it has arrived.
         
+        Args:
+            message_content: Response text from the API
+        """
+        self._request_thread = None
         try:
             # Call agent interface
-            result = self.agent_interface.process_agent_request(prompt)
+            result = self.agent_interface.handle_agent_response(message_content)
             
             if result['status'] == 'success':
                 # Log agent response
@@ -1486,8 +2117,7 @@ class AgentDialog(QDialog):
                 # If multi-action was executed, log all results
                 if 'data' in result and 'action_results' in result['data']:
                     self.log_system_message(_("Executed multiple actions:"))
-                    for action_result in result['data']['action_results']:
-                        self.log_action_result(action_result)
+                    self.log_action_results(result['data']['action_results'])
                         
                     # Add executed actions summary to agent's response
                     success_count = sum(1 for r in result['data']['action_results'] if r.get('status') == 'success')
@@ -1510,9 +2140,9 @@ class AgentDialog(QDialog):
                     else:
                         self.log_agent_message(_("❌ Failed to execute the requested action: {0}").format(
                             action_result.get('message', 'Unknown error')))
-                    
-                # Refresh tree view if data was modified
-                self.local_control.updateAll()
+                
+                # The views were already refreshed by batch_execute, or by
+                # the single action itself
                     
             else:
                 # Log error
@@ -1521,11 +2151,35 @@ class AgentDialog(QDialog):
         except Exception as e:
             self.log_system_message(f"Error: {str(e)}", "error")
             
-        # Restore UI state
+        self._restore_ui_state()
+    
+    def _on_agent_failure(self, error_text):
+        """Log a request that failed before a response arrived.
+        
+        Args:
+            error_text: Description of the error
+        """
+        self._request_thread = None
+        result = self.agent_interface._request_failed(error_text)
+        self.log_system_message(result['message'], "error")
+        self._restore_ui_state()
+    
+    def _restore_ui_state(self):
+        """Re-enable input after a request has finished."""
         self.send_button.setEnabled(True)
         self.progress_bar.setVisible(False)
         self.status_label.setText(_("Ready"))
     
+    def _on_agent_chunk(self, text):
+        """Show streaming progress as response chunks arrive.
+        
+        Args:
+            text: Text chunk received from the API
+        """
+        self._received_chars += len(text)
+        self.status_label.setText(_("Receiving response... ({0} characters)").format(
+            self._received_chars))
+    
     def configure_api_key(self):
         """Show dialog to configure API key."""
         current_key = self.agent_interface._get_api_key()
@@ -1580,6 +2234,7 @@ class AgentDialog(QDialog):
         )
         
         if ok and title:
+            self.agent_interface.refresh_tree_caches()
             node = self.agent_interface.get_node_by_title(title)
             if node:
                 # Display node information
@@ -1593,11 +2248,8 @@ class AgentDialog(QDialog):
                 self.log_system_message(f"Found node with title '{title}':")
                 self.log_system_message(info_text)
                 
-                # Select the node in the tree view
-                for node_id, tree_node in self.agent_interface.tree_structure.nodeDict.items():
-                    if tree_node == node:
-                        self.log_system_message(f"Node ID: {node_id}")
-                        break
+                # nodeDict is keyed by uId, so the node's ID is its uId
+                self.log_system_message(f"Node ID: {node.uId}")
             else:
                 self.log_system_message(f"No node found with title '{title}'", "warning")
                 
@@ -1614,6 +2266,7 @@ class AgentDialog(QDialog):
             return
             
         # Find parent node
+        self.agent_interface.refresh_tree_caches()
         parent_node = None
         if parent_title:
             parent_node = self.agent_interface.get_node_by_title(parent_title)
@@ -1636,7 +2289,7 @@ class AgentDialog(QDialog):
             
         # Create the node
         result = self.agent_interface._action_add_node(
-            parent_id=str(parent_node.uId) if parent_node else None,
+            parent_id=parent_node.uId if parent_node else None,
             title=new_title
         )
         
@@ -1650,7 +2303,8 @@ class AgentDialog(QDialog):
     def show_node_structure(self):
         """Show the structure of all nodes in the tree."""
         try:
-            # Get structure data
+            # Get structure data, cached until the tree is edited here or
+            # in the main window
             structure_data = self.agent_interface._action_get_tree_structure()
             
             if structure_data['status'] == 'success':
@@ -1666,15 +2320,29 @@ class AgentDialog(QDialog):
                 text_edit.setLineWrapMode(QTextEdit.NoWrap)
                 
                 # Create hierarchical view of node titles and IDs
-                def format_structure(node, level=0):
-                    node_text = "  " * level + f"- {node.get('title', 'Untitled')} (ID: {node.get('id', 'unknown')})\n"
-                    child_text = ""
-                    for child in node.get('children', []):
-                        child_text += format_structure(child, level + 1)
-                    return node_text + child_text
-                    
-                structure_text = format_structure(structure_data['tree'])
-                text_edit.setPlainText(structure_text)
+                tree = structure_data['tree']
+                top_nodes = tree['root_nodes'] if 'root_nodes' in tree else [tree]
+                cached_nodes, structure_text = self._structure_cache
+                # Node data dicts are cached until the tree changes, so the
+                # same objects mean the same text
+                if (len(cached_nodes) == len(top_nodes) and
+                        all(a is b for a, b in zip(cached_nodes, top_nodes))):
+                    text_edit.setPlainText(structure_text)
+                elif (len(self.agent_interface.tree_structure.nodeDict) <
+                      _THREADED_STRUCTURE_NODES):
+                    structure_text = _format_structure_text(top_nodes)
+                    self._structure_cache = (top_nodes, structure_text)
+                    text_edit.setPlainText(structure_text)
+                else:
+                    # Format large trees in a worker so the dialog stays responsive
+                    text_edit.setPlainText(_("Building tree structure..."))
+                    worker = StructureTextThread(top_nodes, self)
+                    worker.textReady.connect(text_edit.setPlainText)
+                    worker.textReady.connect(self._store_structure_text)
+                    worker.finished.connect(self._structure_thread_done)
+                    worker.finished.connect(worker.deleteLater)
+                    self._structure_threads.append(worker)
+                    worker.start()
                 
                 # Log ID to title mapping
                 mapping_button = QPushButton(_("Log ID->Title Mapping"))
@@ -1699,6 +2367,18 @@ class AgentDialog(QDialog):
             # Add an alternative method to show nodes
             self.log_node_id_mapping()
             
+    def _store_structure_text(self, structure_text):
+        """Cache text produced by a StructureTextThread.
+        
+        Args:
+            structure_text: The formatted structure text
+        """
+        self._structure_cache = (self.sender().top_nodes, structure_text)
+    
+    def _structure_thread_done(self):
+        """Forget a StructureTextThread that has finished."""
+        self._structure_threads.remove(self.sender())
+            
     def log_node_id_mapping(self):
         """Log all node IDs and their titles for reference."""
         self.log_system_message(_("Node ID to Title Mapping:"))
@@ -1708,27 +2388,29 @@ class AgentDialog(QDialog):
                 self.log_system_message("No nodes found in tree", level="warning")
                 return
                 
+            # Log the mapping as one block rather than one entry per node
+            node_title = self.agent_interface._node_title
+            lines = []
+            errors = []
             for node_id, node in self.agent_interface.tree_structure.nodeDict.items():
                 try:
-                    title = node.title()
-                    self.log_system_message(f"ID: {node_id} => Title: '{title}'", level="info")
+                    lines.append(f"ID: {node_id} => Title: '{node_title(node)}'")
                 except Exception as e:
-                    self.log_system_message(f"Error getting title for node {node_id}: {str(e)}", level="error")
+                    errors.append(f"Error getting title for node {node_id}: {str(e)}")
+            if lines:
+                self.log_system_message('\n'.join(lines), level="info")
+            if errors:
+                self.log_system_message('\n'.join(errors), level="error")
         except Exception as e:
             self.log_system_message(f"Error mapping nodes: {str(e)}", level="error")
             
     def execute_actions_from_log(self):
         """Parse and execute JSON actions from the latest agent message in the log."""
-        # Get all text from the log
-        log_text = self.log_view.toPlainText()
-        
-        # Find the latest assistant message
-        assistant_blocks = log_text.split("[ASSISTANT] ")
-        if len(assistant_blocks) < 2:
+        # Use the latest assistant message, recorded as it was logged
+        latest_message = self._last_assistant_message
+        if latest_message is None:
             self.log_system_message(_("No assistant messages found in log."), "warning")
             return
-            
-        latest_message = assistant_blocks[-1].split("\n[")[0]
         
         # Find JSON in the message
         json_content = None
@@ -1758,11 +2440,19 @@ class AgentDialog(QDialog):
                     return
         else:
             # Try to find JSON-like content in the message (between { and })
-            try:
-                # Find all text between { and } with the most outer brackets
-                import re
-                json_matches = re.findall(r'\{[^{}]*(?:\{[^{}]*\}[^{}]*)*\}', latest_message)
-                if json_matches:
+            start = latest_message.find('{')
+            end = latest_message.rfind('}')
+            if 0 <= start < end:
+                braced_text = latest_message[start:end + 1]
+                try:
+                    # Fast path: the braced text is a single JSON object
+                    json_content = json.loads(braced_text)
+                except json.JSONDecodeError:
+                    pass
+                if not (isinstance(json_content, dict) and
+                        ('action' in json_content or 'actions' in json_content)):
+                    # Find all text between { and } with the most outer brackets
+                    json_matches = _find_json_objects(braced_text)
                     # Try parsing each match starting with the longest one
                     json_matches.sort(key=len, reverse=True)
                     for json_str in json_matches:
@@ -1772,87 +2462,58 @@ class AgentDialog(QDialog):
                                 break
                         except json.JSONDecodeError:
                             continue
-            except:
-                pass
                 
         if not json_content:
             self.log_system_message(_("No JSON content found in the latest message."), "error")
             return
             
-        # Process the JSON content
-        action_results = []
-        
-        # Check for 'actions' list in the content
+        # Process the JSON content as a list of actions
         if 'actions' in json_content and isinstance(json_content['actions'], list):
             self.log_system_message(_("Executing multiple actions..."))
-            # Process each action in the list
-            for action_item in json_content['actions']:
-                if 'action' in action_item and 'parameters' in action_item:
-                    action_name = action_item['action']
-                    parameters = action_item['parameters']
-                    
-                    # Execute the action
-                    try:
-                        self.log_system_message(f"Executing action '{action_name}' with parameters: {parameters}")
-                        result = self.agent_interface.execute_action(action_name, **parameters)
-                        action_results.append(result)
-                        self.log_action_result(result)
-                        
-                        # Special handling for node creation
-                        if action_name == 'add_node' and result['status'] == 'success':
-                            self.agent_interface.last_created_node_id = result.get('node_id')
-                            self.log_system_message(f"Created node with ID: {result.get('node_id')}")
-                            
-                    except Exception as e:
-                        import traceback
-                        error_msg = f"Error executing action '{action_name}': {str(e)}"
-                        self.log_system_message(error_msg, "error")
-                        self.log_system_message(traceback.format_exc(), "error")
-                        action_results.append({'status': 'error', 'message': error_msg})
-                        
-        # Check for single action
+            action_items = [item for item in json_content['actions']
+                            if 'action' in item and 'parameters' in item]
         elif 'action' in json_content and 'parameters' in json_content:
             self.log_system_message(_("Executing single action..."))
-            action_name = json_content['action']
-            parameters = json_content['parameters']
-            
-            # Execute the action
-            try:
-                self.log_system_message(f"Executing action '{action_name}' with parameters: {parameters}")
-                result = self.agent_interface.execute_action(action_name, **parameters)
-                action_results.append(result)
-                self.log_action_result(result)
-                
-                # Special handling for node creation
-                if action_name == 'add_node' and result['status'] == 'success':
-                    self.agent_interface.last_created_node_id = result.get('node_id')
-                    self.log_system_message(f"Created node with ID: {result.get('node_id')}")
-            except Exception as e:
-                import traceback
-                error_msg = f"Error executing action '{action_name}': {str(e)}"
-                self.log_system_message(error_msg, "error")
-                self.log_system_message(traceback.format_exc(), "error")
-                action_results.append({'status': 'error', 'message': error_msg})
-                
+            action_items = [json_content]
         else:
             self.log_system_message(_("JSON content does not contain valid action definition."), "error")
             return
-            
-        # Update the UI
-        self.log_system_message(_("Updating UI with tree changes..."))
-        self.local_control.updateAll()
+        # The tree may have been edited in the main window since the message
+        self.agent_interface.refresh_tree_caches()
         
-        # Summarize the results
-        success_count = sum(1 for r in action_results if r.get('status') == 'success')
-        error_count = sum(1 for r in action_results if r.get('status') == 'error')
+        # Hold the per-action log entries and add them to the log together,
+        # and defer view updates to a single refresh afterwards
+        self._log_buffer = []
+        edit_count = self.agent_interface._edit_count
+        try:
+            with self.agent_interface.deferred_updates():
+                action_results = [self._run_action(item['action'], item['parameters'])
+                                  for item in action_items]
+        finally:
+            self._flush_log()
+            
+        # Update the UI, unless only read-only or failed actions ran
+        if self.agent_interface._edit_count != edit_count:
+            self.log_system_message(_("Updating UI with tree changes..."))
+            self.local_control.updateAll()
+        
+        # Summarize the results, collecting console details in the same pass
+        success_count = error_count = 0
+        details = []
+        for i, result in enumerate(action_results, 1):
+            status = result.get('status', 'unknown')
+            if status == 'success':
+                success_count += 1
+            elif status == 'error':
+                error_count += 1
+            details.append(f"  Action {i}: [{status}] {result.get('message', 'No message')}")
         
         if error_count == 0:
             self.log_system_message(_("✅ All actions executed successfully."))
             
             # Print more details to console for debugging
             print(f"Successfully executed {len(action_results)} actions:")
-            for i, result in enumerate(action_results):
-                print(f"  Action {i+1}: {result.get('message', 'OK')}")
+            print('\n'.join(details))
                 
             # Show specific message for empty trees
             if not self.agent_interface.tree_structure.childList:
@@ -1865,10 +2526,33 @@ class AgentDialog(QDialog):
             
             # Print more details to console for debugging
             print(f"Action execution results: {success_count} succeeded, {error_count} failed")
-            for i, result in enumerate(action_results):
-                status = result.get('status', 'unknown')
-                message = result.get('message', 'No message')
-                print(f"  Action {i+1}: [{status}] {message}")
+            print('\n'.join(details))
+            
+    def _run_action(self, action_name, parameters):
+        """Execute one action from the log and log its result.
+        
+        Args:
+            action_name: Name of the action to execute
+            parameters: Dictionary of action parameters
+            
+        Returns:
+            Dictionary with the action result
+        """
+        try:
+            self.log_system_message(f"Executing action '{action_name}' with parameters: {parameters}")
+            result = self.agent_interface.execute_action(action_name, **parameters)
+            self.log_action_result(result)
+            
+            # Special handling for node creation
+            if action_name == 'add_node' and result['status'] == 'success':
+                self.agent_interface.last_created_node_id = result.get('node_id')
+                self.log_system_message(f"Created node with ID: {result.get('node_id')}")
+        except Exception as e:
+            error_msg = f"Error executing action '{action_name}': {str(e)}"
+            self.log_system_message(error_msg, "error")
+            self.log_system_message(traceback.format_exc(), "error")
+            result = {'status': 'error', 'message': error_msg}
+        return result
             
     def dump_tree_info(self):
         """Dump complete tree structure information for debugging."""
@@ -1901,14 +2585,9 @@ class AgentDialog(QDialog):
                 
             # Log direct tree attributes
             self.log_system_message("TreeStructure attributes:", level="info")
-            for attr in dir(self.agent_interface.tree_structure):
-                if not attr.startswith('_') and attr not in ['nodeDict', 'childList', 'treeFormats']:
-                    try:
-                        value = getattr(self.agent_interface.tree_structure, attr)
-                        if not callable(value):
-                            self.log_system_message(f"  - {attr}: {value}", level="info")
-                    except:
-                        pass
+            for attr in self._DUMP_ATTRIBUTES:
+                value = getattr(self.agent_interface.tree_structure, attr, None)
+                self.log_system_message(f"  - {attr}: {value}", level="info")
             
         except Exception as e:
             self.log_system_message(f"Error dumping tree info: {str(e)}", level="error")
@@ -1919,8 +2598,25 @@ class AgentDialog(QDialog):
         Args:
             event: Close event
         """
+        self._stop_workers()
         self.dialogShown.emit(False)
         super().closeEvent(event)
+    
+    def _stop_workers(self):
+        """Cancel a running agent request and wait for all worker threads.
+        
+        The agent's event loop is closed once no request can be using it.
+        """
+        request_thread = self._request_thread
+        if request_thread is not None and request_thread.isRunning():
+            self.agent_interface.cancel_request()
+            request_thread.wait()
+            self._request_thread = None
+            self._restore_ui_state()
+        # Structure formatting can't be interrupted, but it doesn't take long
+        for worker in self._structure_threads:
+            worker.wait()
+        self.agent_interface.close_event_loop()
 
 
 def _(text):
@@ -12,26 +12,55 @@
 # but WITHOUT ANY WARRANTY. See the included LICENSE file for details.
 #******************************************************************************
 
-from PyQt5.QtCore import Qt, QSize, QRect, QPoint, QModelIndex
-from PyQt5.QtGui import QColor, QPixmap, QPainter, QFont, QIcon, QPen, QBrush, QLinearGradient
+from PyQt5.QtCore import (Qt, QSize, QRect, QPoint, QPointF, QModelIndex, QTimer,
+                          QEvent)
+from PyQt5.QtGui import (QColor, QPixmap, QPainter, QFont, QIcon, QPen, QBrush,
+                         QLinearGradient, QPolygon, QFontMetrics, QStaticText,
+                         QTransform)
 from PyQt5.QtWidgets import (QWidget, QVBoxLayout, QLabel, QHBoxLayout,
                             QLineEdit, QPushButton, QTextEdit, QGridLayout,
                             QScrollArea, QFrame, QSlider, QComboBox)
 
 import globalref
+import collections
 import math
+import operator
 import random
 
+# Smallest node face area, in pixels, that is drawn with gradients
+_MIN_GRADIENT_AREA = 100
+
+# Hit testing uses a grid of cells this many pixels square once more
+# than the given number of nodes are painted
+_HIT_GRID_CELL_SIZE = 64
+_HIT_GRID_MIN_NODES = 200
+
+# Minimum time between hover hit tests while the mouse moves
+_HOVER_INTERVAL_MS = 16
+
 class TreeNode3D:
     """Represents a node in 3D space with position and connections.
     """
-    def __init__(self, title, node_id, parent_id=None):
+    # Fixed attribute slots keep nodes compact and attribute access fast
+    # in the per-node projection and paint loops
+    __slots__ = ('title', 'name', 'node_id', 'parent_id', 'description',
+                 'text', 'x', 'y', 'z', 'color', 'width', 'height', 'depth',
+                 'size', 'level', 'hovered', 'dragging',
+                 'orig_x', 'orig_y', 'orig_z')
+    
+    def __init__(self, title, node_id, parent_id=None, position=None,
+                 color=None, dimensions=None):
         """Initialize the 3D node.
         
+        Random values are only generated for the settings not given.
+        
         Arguments:
             title -- node title/name
             node_id -- unique identifier
             parent_id -- parent node id
+            position -- (x, y, z) tuple, random if None
+            color -- QColor, random if None
+            dimensions -- (width, height, depth) tuple, random if None
         """
         self.title = title
         self.name = ""  # Specific Name field
@@ -41,26 +70,32 @@ class TreeNode3D:
         self.text = ""  # Additional text for hover display
         
         # Initial coordinates in 3D space - will be saved with the data
-        self.x = random.uniform(-300, 300)
-        self.y = random.uniform(-200, 200)
-        self.z = random.uniform(-300, 300)
-        
-        # Projected coordinates (2D)
-        self.px = 0
-        self.py = 0
+        if position is not None:
+            self.x, self.y, self.z = position
+        else:
+            self.x = random.uniform(-300, 300)
+            self.y = random.uniform(-200, 200)
+            self.z = random.uniform(-300, 300)
         
         # Node color - use HSV color space for better differentiation
-        hue = random.uniform(0, 360)
-        self.color = QColor.fromHsv(
-            int(hue),  # Hue
-            random.randint(180, 255),  # Saturation
-            random.randint(180, 255)   # Value
-        )
+        if color is not None:
+            self.color = color
+        else:
+            hue = random.uniform(0, 360)
+            self.color = QColor.fromHsv(
+                int(hue),  # Hue
+                random.randint(180, 255),  # Saturation
+                random.randint(180, 255)   # Value
+            )
         
         # Node dimensions (width, height, depth)
-        self.width = random.uniform(40, 80)
-        self.height = random.uniform(20, 40)
-        self.depth = random.uniform(10, 30)
+        if dimensions is not None:
+            self.width, self.height, self.depth = dimensions
+        else:
+            self.width = random.uniform(40, 80)
+            self.height = random.uniform(20, 40)
+            self.depth = random.uniform(10, 30)
+        self.size = 0
         
         # Default level in the tree
         self.level = 0
@@ -132,11 +167,51 @@ class TreeView3D(QWidget):
         # Tree data
         self.nodes = {}
         self.connections = []
+        # Child IDs for each parent ID, kept in step with connections
+        self._children_index = {}
         self.selected_node = None
         self.hovered_node = None
         
+        # Rotation angles with their sines and cosines, and with the
+        # composed rotation matrix for them
+        self._trig_angles = None
+        self._trig = None
+        self._rotation_angles = None
+        self._rotation = None
+        
+        # View settings of the last projection, None when it must be redone,
+        # and the on-screen node boxes sorted back to front for it
+        self._projection_key = None
+        self._paint_boxes = []
+        # Paint boxes by screen cell for hit testing, built on first use
+        self._hit_grid = None
+        
+        # Node border pens by (alpha, width) and face colors by node state,
+        # color and opacity, reused across paints
+        self._border_pens = {}
+        self._face_color_cache = {}
+        
+        # Label fonts and their metrics by point size, elided label text
+        # by font size, text and width, laid out label text by font size
+        # and text, and the fixed hover hint colors and side pen
+        self._label_fonts = {}
+        self._font_metrics = {}
+        self._elided_texts = {}
+        self._static_texts = {}
+        self._hover_bg_color = QColor(0, 0, 0, 180)
+        self._hover_text_pen = QPen(QColor(255, 255, 220))
+        self._no_pen = QPen(Qt.NoPen)
+        
+        # Box side polygon, updated in place for each side drawn
+        self._side_poly = QPolygon([QPoint(0, 0)] * 4)
+        
+        # Selected node ID and the IDs highlighted for that selection
+        self._highlight_key = None
+        self._highlighted_nodes = set()
+        
         # Interaction state
         self.mouse_down = False
+        self._drag_moved = False
         self.last_mouse_pos = QPoint(0, 0)
         self.current_mouse_pos = QPoint(0, 0)
         
@@ -146,18 +221,28 @@ class TreeView3D(QWidget):
         # Animation timer
         self.animation_active = False
         
-        # Mouse tracking for hover effects
+        # Mouse tracking for hover effects, with the latest position kept
+        # until the pending hover check runs
         self.setMouseTracking(True)
+        self._hover_pos = None
         
-    def create_demo_tree(self):
-        """Create a demo tree structure.
+    def _clear_tree(self):
+        """Remove all nodes and connections and reset the cached views.
         """
         self.nodes.clear()
         self.connections.clear()
+        self._children_index.clear()
+        self._invalidate_projection()
+        self._highlight_key = None
+        self._highlighted_nodes = set()
+        
+    def create_demo_tree(self):
+        """Create a demo tree structure.
+        """
+        self._clear_tree()
         
         # Create root node
-        root = TreeNode3D("Root", "root")
-        root.set_position(0, 0, 0)
+        root = TreeNode3D("Root", "root", position=(0, 0, 0))
         root.size = 25
         self.nodes["root"] = root
         
@@ -176,7 +261,7 @@ class TreeView3D(QWidget):
             node.size = 20
             self.nodes[node_id] = node
             category_ids.append(node_id)
-            self.connections.append(("root", node_id))
+            self._add_connection("root", node_id)
         
         # Second level - documents
         docs = ["Document 1", "Document 2", "Document 3"]
@@ -191,7 +276,7 @@ class TreeView3D(QWidget):
             node.set_position(x, y, z)
             node.size = 15
             self.nodes[node_id] = node
-            self.connections.append((category_ids[0], node_id))
+            self._add_connection(category_ids[0], node_id)
         
         # Projects
         projects = ["Project 1", "Project 2"]
@@ -206,7 +291,7 @@ class TreeView3D(QWidget):
             node.set_position(x, y, z)
             node.size = 15
             self.nodes[node_id] = node
-            self.connections.append((category_ids[1], node_id))
+            self._add_connection(category_ids[1], node_id)
             
             # Add project items
             items = [f"Item {j+1}" for j in range(3)]
@@ -221,7 +306,7 @@ class TreeView3D(QWidget):
                 item_node.set_position(ix, iy, iz)
                 item_node.size = 10
                 self.nodes[item_id] = item_node
-                self.connections.append((node_id, item_id))
+                self._add_connection(node_id, item_id)
         
         # Settings
         settings = ["User Settings", "System Settings"]
@@ -236,7 +321,7 @@ class TreeView3D(QWidget):
             node.set_position(x, y, z)
             node.size = 15
             self.nodes[node_id] = node
-            self.connections.append((category_ids[2], node_id))
+            self._add_connection(category_ids[2], node_id)
             
         self.update()
 
@@ -255,19 +340,17 @@ class TreeView3D(QWidget):
         for i, (key, value) in enumerate(data.items()):
             node_id = f"data_{level}_{i}"
             
-            # Create 3D node
-            node = TreeNode3D(key, node_id, parent_id)
+            # Create 3D node at its initial position
+            node = TreeNode3D(key, node_id, parent_id,
+                              position=(i * 50, level * -100, 0))
             node.size = max(8, 25 - (level * 3))
             
-            # Initial position
-            node.set_position(i * 50, level * -100, 0)
-            
             # Store node
             self.nodes[node_id] = node
             
             # Create connection to parent
             if parent_id:
-                self.connections.append((parent_id, node_id))
+                self._add_connection(parent_id, node_id)
             
             # Process children if value is a dict
             if isinstance(value, dict):
@@ -282,15 +365,13 @@ class TreeView3D(QWidget):
         if not model:
             return False
             
-        self.nodes.clear()
-        self.connections.clear()
+        self._clear_tree()
         
         try:
             # Create a simple tree structure from data
             # First create root node
             root_id = "root"
-            root = TreeNode3D("Root", root_id)
-            root.set_position(0, 0, 0)
+            root = TreeNode3D("Root", root_id, position=(0, 0, 0))
             root.size = 25
             self.nodes[root_id] = root
             
@@ -320,7 +401,7 @@ class TreeView3D(QWidget):
                             self.nodes[node_id] = cat_node
                             
                             # Add connection from root
-                            self.connections.append((root_id, node_id))
+                            self._add_connection(root_id, node_id)
                             
                             # Process child nodes if they exist
                             if hasattr(node, 'childList'):
@@ -339,7 +420,7 @@ class TreeView3D(QWidget):
                                     self.nodes[child_node_id] = child_node
                                     
                                     # Add connection from parent
-                                    self.connections.append((node_id, child_node_id))
+                                    self._add_connection(node_id, child_node_id)
                 except Exception as e:
                     print(f"Error accessing nodes: {e}")
                 
@@ -400,6 +481,9 @@ class TreeView3D(QWidget):
         name = ""
         description = ""
         text = ""
+        pos_x = None
+        pos_y = None
+        pos_z = None
         
         try:
             # Try different methods to get node data
@@ -420,10 +504,6 @@ class TreeView3D(QWidget):
                         text = tree_node.data['Text']
                     
                     # Check for position data
-                    pos_x = None
-                    pos_y = None
-                    pos_z = None
-                    
                     if '3D_Position_X' in tree_node.data:
                         try:
                             pos_x = float(tree_node.data['3D_Position_X'])
@@ -454,37 +534,36 @@ class TreeView3D(QWidget):
         except Exception as e:
             title = f"Node {node_id[-6:]}"
         
-        # Create 3D node
-        node = TreeNode3D(title, node_id, parent_id)
-        node.name = name
-        node.description = description
-        node.text = text
-        node.level = level
-        
         # Scale dimensions based on level
         base_width = 60
         base_height = 40
-        node.width = max(30, base_width + random.uniform(-10, 10))
-        node.height = max(20, base_height + random.uniform(-5, 5))
-        node.depth = max(10, 30 + random.uniform(-3, 3))
+        dimensions = (max(30, base_width + random.uniform(-10, 10)),
+                      max(20, base_height + random.uniform(-5, 5)),
+                      max(10, 30 + random.uniform(-3, 3)))
         
         # Create random coloring, not level-based
         hue = random.uniform(0, 360)
         saturation = 160 + random.randint(0, 95)
         value = 200 + random.randint(0, 55)
-        node.color = QColor.fromHsv(int(hue), saturation, value)
+        color = QColor.fromHsv(int(hue), saturation, value)
         
         # Check if we have saved position data
         if pos_x is not None and pos_y is not None and pos_z is not None:
-            node.set_position(pos_x, pos_y, pos_z)
+            position = (pos_x, pos_y, pos_z)
         else:
             # Assign a random position in 3D space
             spread_factor = 150
-            node.set_position(
-                random.uniform(-spread_factor, spread_factor),
-                random.uniform(-spread_factor, spread_factor),
-                random.uniform(-spread_factor, spread_factor)
-            )
+            position = (random.uniform(-spread_factor, spread_factor),
+                        random.uniform(-spread_factor, spread_factor),
+                        random.uniform(-spread_factor, spread_factor))
+        
+        # Create 3D node
+        node = TreeNode3D(title, node_id, parent_id, position, color,
+                          dimensions)
+        node.name = name
+        node.description = description
+        node.text = text
+        node.level = level
         
         # Store node
         self.nodes[node_id] = node
@@ -514,6 +593,16 @@ class TreeView3D(QWidget):
         except Exception as e:
             print(f"Error processing children: {e}")
     
+    def _add_connection(self, src, dest):
+        """Add a parent-child connection and index it by parent.
+        
+        Arguments:
+            src -- parent node ID
+            dest -- child node ID
+        """
+        self.connections.append((src, dest))
+        self._children_index.setdefault(src, []).append(dest)
+    
     def _layout_tree(self):
         """Arrange nodes in 3D space using a force-directed algorithm.
         """
@@ -531,42 +620,28 @@ class TreeView3D(QWidget):
         root_node = self.nodes[root_id]
         root_node.set_position(0, 0, 0)
         
-        # Layout by level
-        self._layout_level(root_id, 0)
-        
-    def _layout_level(self, node_id, level):
-        """Recursively layout a level of the tree.
-        
-        Arguments:
-            node_id -- ID of the parent node
-            level -- current depth level
-        """
-        # Find children
-        children = []
-        for src, dest in self.connections:
-            if src == node_id:
-                children.append(dest)
-        
-        if not children:
-            return
-            
-        # Calculate positions for children
-        parent = self.nodes[node_id]
-        radius = 120 / (level + 1)
-        
-        for i, child_id in enumerate(children):
-            child = self.nodes[child_id]
-            angle = 2 * math.pi * i / len(children)
-            
-            # Position relative to parent
-            x = parent.x + radius * math.sin(angle)
-            z = parent.z + radius * math.cos(angle)
+        # Layout by level, placing each parent before its children
+        queue = collections.deque([(root_id, 0)])
+        while queue:
+            node_id, level = queue.popleft()
+            children = self._children_index.get(node_id)
+            if not children:
+                continue
+                
+            # Calculate positions for children
+            parent = self.nodes[node_id]
+            radius = 120 / (level + 1)
             y = parent.y - 60 - (level * 20)
+            angle_step = 2 * math.pi / len(children)
             
-            child.set_position(x, y, z)
-            
-            # Recursively layout children
-            self._layout_level(child_id, level + 1)
+            for i, child_id in enumerate(children):
+                angle = angle_step * i
+                
+                # Position relative to parent
+                x = parent.x + radius * math.sin(angle)
+                z = parent.z + radius * math.cos(angle)
+                self.nodes[child_id].set_position(x, y, z)
+                queue.append((child_id, level + 1))
     
     def project_point(self, x, y, z):
         """Project a 3D point onto the 2D screen.
@@ -576,17 +651,11 @@ class TreeView3D(QWidget):
         Returns:
             tuple of 2D (x, y) screen coordinates
         """
-        # Apply rotation around X axis
-        y2 = y * math.cos(self.rotation_x) - z * math.sin(self.rotation_x)
-        z2 = y * math.sin(self.rotation_x) + z * math.cos(self.rotation_x)
-        
-        # Apply rotation around Y axis
-        x3 = x * math.cos(self.rotation_y) + z2 * math.sin(self.rotation_y)
-        z3 = -x * math.sin(self.rotation_y) + z2 * math.cos(self.rotation_y)
-        
-        # Apply rotation around Z axis
-        x4 = x3 * math.cos(self.rotation_z) - y2 * math.sin(self.rotation_z)
-        y4 = x3 * math.sin(self.rotation_z) + y2 * math.cos(self.rotation_z)
+        # Apply the rotation around the X, Y and Z axes
+        row_x, row_y, row_z = self._rotation_matrix()
+        x4 = row_x[0] * x + row_x[1] * y + row_x[2] * z
+        y4 = row_y[0] * x + row_y[1] * y + row_y[2] * z
+        z3 = row_z[0] * x + row_z[1] * y + row_z[2] * z
         
         # Calculate perspective projection
         f = 1000  # focal length
@@ -601,6 +670,129 @@ class TreeView3D(QWidget):
         
         return (px, py)
     
+    def _rotation_trig(self):
+        """Return cached (cos_x, sin_x, cos_y, sin_y, cos_z, sin_z).
+        
+        The values are recomputed only when the rotation angles change.
+        """
+        angles = (self.rotation_x, self.rotation_y, self.rotation_z)
+        if angles != self._trig_angles:
+            self._trig = (math.cos(self.rotation_x), math.sin(self.rotation_x),
+                          math.cos(self.rotation_y), math.sin(self.rotation_y),
+                          math.cos(self.rotation_z), math.sin(self.rotation_z))
+            self._trig_angles = angles
+        return self._trig
+    
+    def _rotation_matrix(self):
+        """Return the composed view rotation matrix as three row tuples.
+        
+        The rotation is around X, then Y, then Z.  The matrix is cached
+        until the rotation angles change.
+        """
+        angles = (self.rotation_x, self.rotation_y, self.rotation_z)
+        if angles == self._rotation_angles:
+            return self._rotation
+        cos_x, sin_x, cos_y, sin_y, cos_z, sin_z = self._rotation_trig()
+        self._rotation = ((cos_z * cos_y,
+                           cos_z * sin_y * sin_x - sin_z * cos_x,
+                           cos_z * sin_y * cos_x + sin_z * sin_x),
+                          (sin_z * cos_y,
+                           sin_z * sin_y * sin_x + cos_z * cos_x,
+                           sin_z * sin_y * cos_x - cos_z * sin_x),
+                          (-sin_y, cos_y * sin_x, cos_y * cos_x))
+        self._rotation_angles = angles
+        return self._rotation
+    
+    def _project_nodes(self):
+        """Project all nodes onto the 2D screen in a single pass.
+        
+        Returns a list of (z, px, py, node) tuples for the nodes that are
+        in front of the camera, with px and py the screen coordinates.
+        """
+        ((m00, m01, m02), (m10, m11, m12),
+         (m20, m21, m22)) = self._rotation_matrix()
+        f = 1000  # focal length
+        camera_distance = self.camera_distance
+        scale = self.scale
+        center_x = self.center_x
+        center_y = self.center_y
+        projected = []
+        for node in self.nodes.values():
+            x, y, z = node.x, node.y, node.z
+            distance = m20 * x + m21 * y + m22 * z + camera_distance
+            if distance <= 0:
+                # Point is behind camera
+                continue
+            scale_factor = f / distance * scale
+            projected.append((z,
+                              (m00 * x + m01 * y + m02 * z) * scale_factor + center_x,
+                              (m10 * x + m11 * y + m12 * z) * scale_factor + center_y,
+                              node))
+        return projected
+    
+    def _onscreen_boxes(self, projected):
+        """Return the screen boxes of the nodes that overlap the widget.
+        
+        Each box is a tuple of the node, its rectangle x and y, its scaled
+        width, height and depth and its opacity.
+        
+        Arguments:
+            projected -- (z, px, py, node) tuples to check, order is kept
+        """
+        view_width = self.width()
+        view_height = self.height()
+        camera_distance = self.camera_distance
+        scale = self.scale
+        boxes = []
+        for z, px, py, node in projected:
+            # Calculate depth factor for scaling and opacity
+            z_factor = 800 / (z + camera_distance + 800)
+            width = node.width * z_factor * scale
+            height = node.height * z_factor * scale
+            depth = node.depth * z_factor * scale
+            rect_x = int(px - width/2)
+            rect_y = int(py - height/2)
+            # Allow for the box sides drawn below and to the right
+            side_offset = depth * 0.3
+            if (rect_x + width + side_offset >= 0 and rect_x <= view_width and
+                    rect_y + height + side_offset >= 0 and
+                    rect_y <= view_height):
+                opacity = min(255, max(50, int(255 * z_factor)))
+                boxes.append((node, rect_x, rect_y, width, height, depth,
+                              opacity))
+        return boxes
+    
+    def _move_paint_box(self, node):
+        """Reproject one moved node and replace its cached paint box.
+        
+        The box keeps its place in the back to front order until the
+        next full projection.
+        
+        Arguments:
+            node -- the moved 3D node
+        """
+        px, py = self.project_point(node.x, node.y, node.z)
+        z_factor = 800 / (node.z + self.camera_distance + 800)
+        width = node.width * z_factor * self.scale
+        height = node.height * z_factor * self.scale
+        depth = node.depth * z_factor * self.scale
+        opacity = min(255, max(50, int(255 * z_factor)))
+        box = (node, int(px - width/2), int(py - height/2), width, height,
+               depth, opacity)
+        boxes = self._paint_boxes
+        for i, old_box in enumerate(boxes):
+            if old_box[0] is node:
+                boxes[i] = box
+                break
+        else:
+            boxes.append(box)
+        self._hit_grid = None
+    
+    def _invalidate_projection(self):
+        """Force the next paint to reproject the nodes after they change.
+        """
+        self._projection_key = None
+    
     def paintEvent(self, event):
         """Paint the 3D visualization.
         
@@ -617,79 +809,84 @@ class TreeView3D(QWidget):
         # Draw background
         painter.fillRect(event.rect(), self.background_color)
         
-        # Project all nodes to 2D
-        for node_id, node in self.nodes.items():
-            px, py = self.project_point(node.x, node.y, node.z)
-            node.px = px
-            node.py = py
-        
-        # Create a list of selected nodes and their children for highlighting
-        highlighted_nodes = set()
-        if self.selected_node:
-            highlighted_nodes.add(self.selected_node)
-            self._add_children_recursive(self.selected_node, highlighted_nodes)
-        
-        # Sort nodes by Z distance for proper rendering (back to front)
-        sorted_nodes = sorted(
-            self.nodes.values(), 
-            key=lambda node: node.z + self.camera_distance, 
-            reverse=True
-        )
+        # Project all nodes to 2D unless the view and nodes are unchanged,
+        # as on hover and selection repaints
+        view_key = (self.rotation_x, self.rotation_y, self.rotation_z,
+                    self.scale, self.camera_distance,
+                    self.center_x, self.center_y)
+        if view_key != self._projection_key:
+            projected = self._project_nodes()
+            # Sort nodes by Z distance for proper rendering (back to front)
+            # The camera distance is the same for all nodes, so z alone
+            # gives the order
+            projected.sort(key=operator.itemgetter(0), reverse=True)
+            # Skip nodes behind the camera or outside the widget
+            self._paint_boxes = self._onscreen_boxes(projected)
+            self._hit_grid = None
+            self._projection_key = view_key
+        
+        # Create a set of selected nodes and their children for highlighting,
+        # kept until the selection changes
+        if self.selected_node != self._highlight_key:
+            self._highlighted_nodes = set()
+            if self.selected_node:
+                self._highlighted_nodes.add(self.selected_node)
+                self._add_children_recursive(self.selected_node,
+                                             self._highlighted_nodes)
+            self._highlight_key = self.selected_node
+        highlighted_nodes = self._highlighted_nodes
         
         # We no longer draw connections between nodes
         
-        # Draw nodes as rectangles
-        for node in sorted_nodes:
-            # Calculate depth factor for scaling and opacity
-            z_factor = 800 / (node.z + self.camera_distance + 800)
-            width = node.width * z_factor * self.scale
-            height = node.height * z_factor * self.scale
-            depth = node.depth * z_factor * self.scale
-            opacity = min(255, max(50, int(255 * z_factor)))
-            
+        # Reusable four point polygon for the box sides
+        side_poly = self._side_poly
+        
+        # Pen and font last set on the painter, so that unchanged ones
+        # are not set again for the next node
+        no_pen = self._no_pen
+        current_pen = None
+        current_font = None
+        
+        # Box of the hovered node, for the hint drawn after all nodes
+        hovered_box = None
+        
+        # Only nodes reaching the repainted area need drawing, as when
+        # just the old and new hovered nodes are updated
+        clip_rect = event.rect()
+        clip_left, clip_top = clip_rect.left(), clip_rect.top()
+        clip_right, clip_bottom = clip_rect.right(), clip_rect.bottom()
+        
+        # Draw nodes as rectangles, using the sizes computed at projection
+        for box in self._paint_boxes:
+            node, rect_x, rect_y, width, height, depth, opacity = box
             # Determine if node is highlighted (selected or child of selected)
             is_highlighted = node.node_id in highlighted_nodes
             is_hovered = node.node_id == self.hovered_node
             
+            # Skip nodes outside the repainted area, checking the label
+            # overhang only when the box itself is outside it
+            side_offset = depth * 0.3
+            if (not is_hovered and
+                    (rect_x > clip_right or rect_y > clip_bottom or
+                     rect_x + width + side_offset < clip_left or
+                     rect_y + height + side_offset < clip_top) and
+                    not self._box_region(box).intersects(clip_rect)):
+                continue
+            
             # Create 3D effect with offset rectangles
             offset_x = int(depth * 0.3)
             offset_y = int(depth * 0.3)
             
-            # Calculate rectangle position
-            rect_x = int(node.px - width/2)
-            rect_y = int(node.py - height/2)
+            # Get colors for the gradients of the main face and sides
+            base_color, edge_color, light_color, text_pen = self._face_colors(
+                node, opacity, is_highlighted, is_hovered)
             
-            # Create gradients for main face and sides
-            if is_highlighted:
-                # Use highlight colors for selected nodes
-                base_color = self.highlight_color
-                edge_color = QColor(
-                    min(255, base_color.red() + 20),
-                    min(255, base_color.green() + 20),
-                    min(255, base_color.blue() - 40),
-                    opacity
-                )
-            elif is_hovered:
-                # Special hover color
-                base_color = QColor(255, 255, 200, opacity)
-                edge_color = QColor(200, 200, 150, opacity)
-            else:
-                # Use node's own color
-                base_color = QColor(
-                    node.color.red(),
-                    node.color.green(),
-                    node.color.blue(),
-                    opacity
-                )
-                edge_color = QColor(
-                    max(0, node.color.red() - 40),
-                    max(0, node.color.green() - 40),
-                    max(0, node.color.blue() - 40),
-                    opacity
-                )
+            # Gradients can't be seen on small boxes, so those get a
+            # solid face and no sides
+            use_gradients = width * height >= _MIN_GRADIENT_AREA
             
             # Draw the 3D box sides first (if visible and large enough)
-            if depth > 3 and width > 5 and height > 5:
+            if use_gradients and depth > 3 and width > 5 and height > 5:
                 # Right side
                 side_gradient = QLinearGradient(
                     rect_x + width, rect_y,
@@ -698,13 +895,14 @@ class TreeView3D(QWidget):
                 side_gradient.setColorAt(0, base_color)
                 side_gradient.setColorAt(1, edge_color)
                 painter.setBrush(QBrush(side_gradient))
-                painter.setPen(Qt.NoPen)
-                painter.drawPolygon([
-                    QPoint(int(rect_x + width), int(rect_y)),
-                    QPoint(int(rect_x + width + offset_x), int(rect_y + offset_y)),
-                    QPoint(int(rect_x + width + offset_x), int(rect_y + height + offset_y)),
-                    QPoint(int(rect_x + width), int(rect_y + height))
-                ])
+                if current_pen is not no_pen:
+                    current_pen = no_pen
+                    painter.setPen(current_pen)
+                side_poly.setPoint(0, int(rect_x + width), int(rect_y))
+                side_poly.setPoint(1, int(rect_x + width + offset_x), int(rect_y + offset_y))
+                side_poly.setPoint(2, int(rect_x + width + offset_x), int(rect_y + height + offset_y))
+                side_poly.setPoint(3, int(rect_x + width), int(rect_y + height))
+                painter.drawPolygon(side_poly)
                 
                 # Bottom side
                 bottom_gradient = QLinearGradient(
@@ -714,106 +912,326 @@ class TreeView3D(QWidget):
                 bottom_gradient.setColorAt(0, base_color)
                 bottom_gradient.setColorAt(1, edge_color)
                 painter.setBrush(QBrush(bottom_gradient))
-                painter.drawPolygon([
-                    QPoint(int(rect_x), int(rect_y + height)),
-                    QPoint(int(rect_x + offset_x), int(rect_y + height + offset_y)),
-                    QPoint(int(rect_x + width + offset_x), int(rect_y + height + offset_y)),
-                    QPoint(int(rect_x + width), int(rect_y + height))
-                ])
+                side_poly.setPoint(0, int(rect_x), int(rect_y + height))
+                side_poly.setPoint(1, int(rect_x + offset_x), int(rect_y + height + offset_y))
+                side_poly.setPoint(2, int(rect_x + width + offset_x), int(rect_y + height + offset_y))
+                side_poly.setPoint(3, int(rect_x + width), int(rect_y + height))
+                painter.drawPolygon(side_poly)
             
             # Draw main rectangle face
-            main_gradient = QLinearGradient(
-                rect_x, rect_y,
-                rect_x + width, rect_y + height
-            )
-            main_gradient.setColorAt(0, QColor(
-                min(255, base_color.red() + 30),
-                min(255, base_color.green() + 30),
-                min(255, base_color.blue() + 30),
-                opacity
-            ))
-            main_gradient.setColorAt(1, base_color)
+            if use_gradients:
+                main_gradient = QLinearGradient(
+                    rect_x, rect_y,
+                    rect_x + width, rect_y + height
+                )
+                main_gradient.setColorAt(0, light_color)
+                main_gradient.setColorAt(1, base_color)
+                painter.setBrush(QBrush(main_gradient))
+            else:
+                painter.setBrush(base_color)
             
             # Draw the main rectangle with a thin border
-            painter.setBrush(QBrush(main_gradient))
-            border_color = QColor(30, 30, 30, min(200, opacity))
             border_width = 1 if not is_highlighted else 2
-            painter.setPen(QPen(border_color, border_width))
+            border_pen = self._border_pen(min(200, opacity), border_width)
+            if current_pen is not border_pen:
+                current_pen = border_pen
+                painter.setPen(current_pen)
             painter.drawRect(rect_x, rect_y, int(width), int(height))
             
             # Draw the Name field on the face of the rectangle
-            if node.name and width > 15 and height > 10:
+            label = self._label_text(node, width, height)
+            if label:
                 # Draw name text directly on the rectangle
-                font = painter.font()
-                font.setPointSize(max(7, min(9, int((width + height) / 18))))
-                painter.setFont(font)
-                
-                # Text color - white or black depending on background brightness
-                brightness = (base_color.red() * 299 + base_color.green() * 587 + base_color.blue() * 114) / 1000
-                if brightness > 128:
-                    text_color = QColor(0, 0, 0, min(255, int(opacity * 1.2)))
-                else:
-                    text_color = QColor(255, 255, 255, min(255, int(opacity * 1.2)))
+                point_size, static_text = label
+                font = self._label_font(point_size)
+                if current_font is not font:
+                    current_font = font
+                    painter.setFont(current_font)
+                if current_pen is not text_pen:
+                    current_pen = text_pen
+                    painter.setPen(current_pen)
                 
-                painter.setPen(QPen(text_color))
-                
-                # Center the name on the rectangle
-                name_rect = QRect(
-                    rect_x, 
-                    rect_y, 
-                    int(width), 
-                    int(height)
+                # Center the name on the rectangle, reusing its text layout
+                text_size = static_text.size()
+                painter.drawStaticText(
+                    QPointF(rect_x + (width - text_size.width()) / 2,
+                            rect_y + (height - text_size.height()) / 2),
+                    static_text
                 )
-                
-                # Make the text fit within the box
-                displayed_name = node.name
-                if font.pointSize() > 7:
-                    metrics = painter.fontMetrics()
-                    if metrics.width(displayed_name) > width - 8:
-                        # Truncate with ellipsis if too long
-                        displayed_name = metrics.elidedText(displayed_name, Qt.ElideRight, int(width) - 8)
-                
-                painter.drawText(name_rect, Qt.AlignCenter, displayed_name)
             
-            # Draw hover hint (text or description)
             if is_hovered:
-                # If we have a text field or description, show it
-                hover_text = node.text if node.text else node.description
+                hovered_box = (node, rect_x, rect_y, width)
+        
+        # Draw hover hint (text or description) after all of the nodes,
+        # so that it is on top and needs only one font and pen change
+        if hovered_box:
+            node, rect_x, rect_y, width = hovered_box
+            # If we have a text field or description, show it
+            hover_text = node.text if node.text else node.description
+            
+            if hover_text:
+                # Position hover text above the node
+                hint_rect = QRect(
+                    int(rect_x + width/2 - 150),
+                    rect_y - 50,
+                    300,
+                    40
+                )
                 
-                if hover_text:
-                    # Position hover text above the node
-                    hint_rect = QRect(
-                        int(node.px - 150),
-                        int(node.py - height/2 - 50),
-                        300,
-                        40
-                    )
-                    
-                    # Draw a semi-transparent background for better readability
-                    painter.fillRect(hint_rect, QColor(0, 0, 0, 180))
-                    
-                    # Draw hover text
-                    font = painter.font()
-                    font.setPointSize(9)
-                    painter.setFont(font)
-                    painter.setPen(QPen(QColor(255, 255, 220)))
-                    
-                    # If text is too long, truncate it
-                    metrics = painter.fontMetrics()
-                    elided_text = metrics.elidedText(hover_text, Qt.ElideRight, 290)
-                    painter.drawText(hint_rect, Qt.AlignCenter, elided_text)
+                # Draw a semi-transparent background for better readability
+                painter.fillRect(hint_rect, self._hover_bg_color)
+                
+                # Draw hover text
+                painter.setFont(self._label_font(9))
+                painter.setPen(self._hover_text_pen)
+                
+                # If text is too long, truncate it
+                elided_text = self._elided_text(9, hover_text, 290)
+                static_text = self._static_text(9, elided_text)
+                text_size = static_text.size()
+                painter.drawStaticText(
+                    QPointF(hint_rect.x() + (hint_rect.width() - text_size.width()) / 2,
+                            hint_rect.y() + (hint_rect.height() - text_size.height()) / 2),
+                    static_text
+                )
+    
+    def _label_text(self, node, width, height):
+        """Return (point size, static text) for a node's label, or None.
+        
+        Arguments:
+            node -- the 3D node to label
+            width, height -- the node's box size on screen
+        """
+        if not node.name or width <= 15 or height <= 10:
+            return None
+        point_size = max(7, min(9, int((width + height) / 18)))
+        
+        # Make the text fit within the box
+        displayed_name = node.name
+        if point_size > 7:
+            # Truncate with ellipsis if too long
+            displayed_name = self._elided_text(point_size, displayed_name,
+                                               int(width) - 8)
+        return (point_size, self._static_text(point_size, displayed_name))
+    
+    def _box_region(self, box, with_hint=False):
+        """Return the screen rectangle painted for a node's box.
+        
+        Covers the box face and sides, with a margin for the border, and
+        any label text running past the box.
+        
+        Arguments:
+            box -- the node's paint box tuple
+            with_hint -- also cover the hover hint above the node if True
+        """
+        node, rect_x, rect_y, width, height, depth, opacity = box
+        side_offset = int(depth * 0.3)
+        region = QRect(rect_x, rect_y, int(width) + side_offset,
+                       int(height) + side_offset).adjusted(-2, -2, 2, 2)
+        label = self._label_text(node, width, height)
+        if label:
+            text_size = label[1].size()
+            region = region.united(
+                QRect(int(rect_x + (width - text_size.width()) / 2),
+                      int(rect_y + (height - text_size.height()) / 2),
+                      int(text_size.width()) + 2,
+                      int(text_size.height()) + 2))
+        if with_hint and (node.text or node.description):
+            region = region.united(QRect(int(rect_x + width/2 - 150),
+                                         rect_y - 50, 300, 40))
+        return region
+    
+    def _hover_region(self, node_id):
+        """Return the screen rectangle that changes when a node's hover
+        state changes, or an empty rectangle if the node is not painted.
+        
+        Arguments:
+            node_id -- the ID of the node
+        """
+        if node_id is None:
+            return QRect()
+        for box in self._paint_boxes:
+            if box[0].node_id == node_id:
+                return self._box_region(box, True)
+        return QRect()
+    
+    def _face_colors(self, node, opacity, is_highlighted, is_hovered):
+        """Return cached base, edge and light face colors and text pen.
+        
+        Colors are shared by all nodes with the same state, color and
+        opacity, so they are only built the first time they are used.
+        
+        Arguments:
+            node -- the 3D node to get colors for
+            opacity -- alpha value for the colors
+            is_highlighted -- True if the node is selected or a descendant
+            is_hovered -- True if the mouse is over the node
+        """
+        if is_highlighted:
+            key = ('highlight', opacity)
+        elif is_hovered:
+            key = ('hover', opacity)
+        else:
+            key = (node.color.rgb(), opacity)
+        colors = self._face_color_cache.get(key)
+        if colors is not None:
+            return colors
+            
+        if is_highlighted:
+            # Use highlight colors for selected nodes
+            base_color = self.highlight_color
+            red, green, blue = (base_color.red(), base_color.green(),
+                                base_color.blue())
+            edge_color = QColor(
+                min(255, red + 20),
+                min(255, green + 20),
+                min(255, blue - 40),
+                opacity
+            )
+        elif is_hovered:
+            # Special hover color
+            red, green, blue = 255, 255, 200
+            base_color = QColor(red, green, blue, opacity)
+            edge_color = QColor(200, 200, 150, opacity)
+        else:
+            # Use node's own color, unpacked from the packed RGB key
+            rgb = key[0] & 0xffffff
+            red, green, blue = rgb >> 16, (rgb >> 8) & 0xff, rgb & 0xff
+            base_color = QColor.fromRgba((opacity << 24) | rgb)
+            edge_color = QColor(
+                max(0, red - 40),
+                max(0, green - 40),
+                max(0, blue - 40),
+                opacity
+            )
+        light_color = QColor(
+            min(255, red + 30),
+            min(255, green + 30),
+            min(255, blue + 30),
+            opacity
+        )
+        
+        # Text color - white or black depending on background brightness
+        brightness = (red * 299 + green * 587 + blue * 114) / 1000
+        if brightness > 128:
+            text_color = QColor(0, 0, 0, min(255, int(opacity * 1.2)))
+        else:
+            text_color = QColor(255, 255, 255, min(255, int(opacity * 1.2)))
+        
+        # Opacity varies with depth, so bound the cache on large trees
+        if len(self._face_color_cache) >= 4096:
+            self._face_color_cache.clear()
+        colors = (base_color, edge_color, light_color, QPen(text_color))
+        self._face_color_cache[key] = colors
+        return colors
+    
+    def _label_font(self, point_size):
+        """Return a cached copy of the widget font at the given size.
+        
+        Arguments:
+            point_size -- font point size
+        """
+        font = self._label_fonts.get(point_size)
+        if font is None:
+            font = QFont(self.font())
+            font.setPointSize(point_size)
+            self._label_fonts[point_size] = font
+        return font
+    
+    def _label_metrics(self, point_size):
+        """Return cached font metrics for a label point size.
+        
+        Arguments:
+            point_size -- label font point size
+        """
+        metrics = self._font_metrics.get(point_size)
+        if metrics is None:
+            metrics = QFontMetrics(self._label_font(point_size), self)
+            self._font_metrics[point_size] = metrics
+        return metrics
+    
+    def _elided_text(self, point_size, text, max_width):
+        """Return text elided to fit a width, cached across paints.
+        
+        Arguments:
+            point_size -- label font point size
+            text -- the full text
+            max_width -- available width in pixels
+        """
+        key = (point_size, text, max_width)
+        elided = self._elided_texts.get(key)
+        if elided is None:
+            metrics = self._label_metrics(point_size)
+            elided = text
+            if metrics.width(text) > max_width:
+                elided = metrics.elidedText(text, Qt.ElideRight, max_width)
+            # Widths change with zoom, so bound the cache on large trees
+            if len(self._elided_texts) >= 4096:
+                self._elided_texts.clear()
+            self._elided_texts[key] = elided
+        return elided
+    
+    def _static_text(self, point_size, text):
+        """Return a cached, laid out QStaticText for a label.
+        
+        Arguments:
+            point_size -- label font point size
+            text -- the text to draw
+        """
+        key = (point_size, text)
+        static_text = self._static_texts.get(key)
+        if static_text is None:
+            static_text = QStaticText(text)
+            static_text.setTextFormat(Qt.PlainText)
+            static_text.prepare(QTransform(), self._label_font(point_size))
+            if len(self._static_texts) >= 4096:
+                self._static_texts.clear()
+            self._static_texts[key] = static_text
+        return static_text
+    
+    def changeEvent(self, event):
+        """Drop the cached label fonts and text when the font changes.
+        
+        Arguments:
+            event -- change event
+        """
+        if event.type() == QEvent.FontChange:
+            self._label_fonts.clear()
+            self._font_metrics.clear()
+            self._elided_texts.clear()
+            self._static_texts.clear()
+        super().changeEvent(event)
+    
+    def _border_pen(self, alpha, width):
+        """Return a cached node border pen.
+        
+        Arguments:
+            alpha -- border color alpha value
+            width -- pen width
+        """
+        key = (alpha, width)
+        pen = self._border_pens.get(key)
+        if pen is None:
+            pen = QPen(QColor(30, 30, 30, alpha), width)
+            self._border_pens[key] = pen
+        return pen
     
     def _add_children_recursive(self, node_id, highlighted_set):
-        """Add all children of a node to the highlighted set recursively.
+        """Add all descendants of a node to the highlighted set.
+        
+        Uses an explicit stack rather than recursion.
         
         Arguments:
             node_id -- the parent node ID
             highlighted_set -- set to add child node IDs to
         """
-        for src, dest in self.connections:
-            if src == node_id:
-                highlighted_set.add(dest)
-                self._add_children_recursive(dest, highlighted_set)
+        children_index = self._children_index
+        stack = [node_id]
+        while stack:
+            for dest in children_index.get(stack.pop(), ()):
+                if dest not in highlighted_set:
+                    highlighted_set.add(dest)
+                    stack.append(dest)
     
     def mousePressEvent(self, event):
         """Handle mouse press events.
@@ -849,6 +1267,12 @@ class TreeView3D(QWidget):
                 node.dragging = False
                 # Here we would save the position to the TreeLine data
                 # self._save_node_position(node) - implemented later
+        
+        # Restore the depth order after a drag moved a node
+        if self._drag_moved:
+            self._drag_moved = False
+            self._invalidate_projection()
+            self.update()
     
     def mouseMoveEvent(self, event):
         """Handle mouse move events for rotation and hover/drag effects.
@@ -880,9 +1304,11 @@ class TreeView3D(QWidget):
                 sensitivity = 2.0 / (z_factor * self.scale)
                 
                 # Apply rotation matrix inverse to determine 3D movement
-                # These calculations counteract the camera rotation to move in world space
-                cos_y = math.cos(-self.rotation_y)
-                sin_y = math.sin(-self.rotation_y)
+                # These calculations counteract the camera rotation to move in world space,
+                # using cos(-y) = cos(y) and sin(-y) = -sin(y) with the cached values
+                trig = self._rotation_trig()
+                cos_y = trig[2]
+                sin_y = -trig[3]
                 
                 # Calculate world space movement
                 world_dx = (dx * cos_y - dy * sin_y) * sensitivity
@@ -891,6 +1317,10 @@ class TreeView3D(QWidget):
                 # Update the node position
                 dragging_node.update_position_by_offset(world_dx, 0, world_dz)
                 
+                # Move only this node's box while dragging, and sort the
+                # boxes again once the drag ends
+                self._move_paint_box(dragging_node)
+                self._drag_moved = True
                 self.update()
             else:
                 # Not dragging a node, so rotate the view
@@ -901,12 +1331,29 @@ class TreeView3D(QWidget):
                 
             self.last_mouse_pos = event.pos()
         else:
-            # Check for node hover when not dragging
-            hovered = self._find_node_at_position(event.x(), event.y())
-            
-            if hovered != self.hovered_node:
-                self.hovered_node = hovered
-                self.update()
+            # Check for node hover when not dragging, at most once per
+            # hover interval for a burst of mouse moves
+            if self._hover_pos is None:
+                QTimer.singleShot(_HOVER_INTERVAL_MS, self._update_hover)
+            self._hover_pos = event.pos()
+    
+    def _update_hover(self):
+        """Update the hovered node from the latest mouse position.
+        
+        Repaints only if the hovered node changed, and then only the areas
+        of the old and new hovered nodes.  The repaint reuses the cached
+        projection.
+        """
+        pos, self._hover_pos = self._hover_pos, None
+        if pos is None or self.mouse_down:
+            return
+        hovered = self._find_node_at_position(pos.x(), pos.y())
+        
+        if hovered != self.hovered_node:
+            # Repaint only the areas of the old and new hovered nodes
+            self.update(self._hover_region(self.hovered_node))
+            self.hovered_node = hovered
+            self.update(self._hover_region(hovered))
                 
     def _save_node_position(self, node):
         """Save the node position to the TreeLine data.
@@ -930,22 +1377,17 @@ class TreeView3D(QWidget):
         Returns:
             node_id or None if no node at position
         """
-        # Process nodes from front to back for proper hit testing
-        sorted_nodes = sorted(
-            self.nodes.values(), 
-            key=lambda node: node.z + self.camera_distance
-        )
-        
-        for node in sorted_nodes:
-            # Calculate node rectangle dimensions
-            z_factor = 800 / (node.z + self.camera_distance + 800)
-            width = node.width * z_factor * self.scale
-            height = node.height * z_factor * self.scale
-            
-            # Calculate rectangle position
-            rect_x = int(node.px - width/2)
-            rect_y = int(node.py - height/2)
-            
+        # Process the painted boxes from front to back for proper hit testing,
+        # only checking those in the position's grid cell on large trees
+        if len(self._paint_boxes) > _HIT_GRID_MIN_NODES:
+            if self._hit_grid is None:
+                self._hit_grid = self._build_hit_grid()
+            boxes = self._hit_grid.get((int(x) // _HIT_GRID_CELL_SIZE,
+                                        int(y) // _HIT_GRID_CELL_SIZE), ())
+        else:
+            boxes = reversed(self._paint_boxes)
+        for (node, rect_x, rect_y, width, height, depth,
+             opacity) in boxes:
             # Hit testing with rectangle
             if (x >= rect_x and x <= rect_x + width and
                 y >= rect_y and y <= rect_y + height):
@@ -953,6 +1395,22 @@ class TreeView3D(QWidget):
                 
         return None
     
+    def _build_hit_grid(self):
+        """Return the painted boxes bucketed by the screen cells they overlap.
+        
+        Each cell's list is ordered from front to back.
+        """
+        cell_size = _HIT_GRID_CELL_SIZE
+        grid = {}
+        for box in reversed(self._paint_boxes):
+            rect_x, rect_y, width, height = box[1:5]
+            for cell_x in range(rect_x // cell_size,
+                                int(rect_x + width) // cell_size + 1):
+                for cell_y in range(rect_y // cell_size,
+                                    int(rect_y + height) // cell_size + 1):
+                    grid.setdefault((cell_x, cell_y), []).append(box)
+        return grid
+    
     def wheelEvent(self, event):
         """Handle mouse wheel events for zoom.
         
@@ -1051,6 +1509,7 @@ class ThreeDViewWidget(QWidget):
         self.log_area = QTextEdit()
         self.log_area.setReadOnly(True)
         self.log_area.setMaximumHeight(80)
+        self.log_area.document().setMaximumBlockCount(1000)
         self.log_area.setPlaceholderText(_("Status log will appear here"))
         self.layout.addWidget(self.log_area)
         
@@ -1158,9 +1617,10 @@ class ThreeDViewWidget(QWidget):
         self.log_message(_("Saving node positions..."))
         
         # Implementation would require access to TreeLine data model
-        # For now, just log the positions we would save
-        for node_id, node in self.tree_view.nodes.items():
-            x, y, z = node.x, node.y, node.z
-            self.log_message(f"Node {node_id}: Position ({x:.1f}, {y:.1f}, {z:.1f})")
+        # For now, just log the positions we would save, in a single append
+        if self.tree_view.nodes:
+            self.log_message('\n'.join(
+                f"Node {node_id}: Position ({node.x:.1f}, {node.y:.1f}, {node.z:.1f})"
+                for node_id, node in self.tree_view.nodes.items()))
         
         self.log_message(_("Positions saved (simulated)"))
\ No newline at end of file
@@ -0,0 +1,17 @@
+"""Test setup matching what treeline.py does before importing its modules."""
+
+import builtins
+import pathlib
+import sys
+
+sys.path.insert(0, str(pathlib.Path(__file__).parent.parent / 'source'))
+
+
+def _mark_no_translate(text, comment=''):
+    """Dummy translation function, only used to mark text."""
+    return text
+
+
+# TreeLine modules use the gettext style translation builtins at import time
+builtins._ = _mark_no_translate
+builtins.N_ = _mark_no_translate
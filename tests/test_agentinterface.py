@@ -0,0 +1,44 @@
+"""Tests for the JSON extraction helpers of the agent interface."""
+
+import json
+import time
+
+import pytest
+
+pytest.importorskip('PyQt5')
+pytest.importorskip('anthropic')
+
+import agentinterface
+
+
+def test_find_json_objects_after_unmatched_brace():
+    text = ('Remember to use {braces in titles. '
+            '{"action": "add_node", "parameters": {"title": "New {node}"}}')
+    spans = agentinterface._find_json_objects(text)
+    assert [json.loads(span) for span in spans] == [
+        {'action': 'add_node', 'parameters': {'title': 'New {node}'}}]
+
+
+def test_find_json_objects_inside_invalid_span():
+    text = '{see {"action": "get_node", "parameters": {}}} and a trailing {'
+    spans = agentinterface._find_json_objects(text)
+    assert spans == ['{"action": "get_node", "parameters": {}}']
+
+
+def test_find_json_objects_keeps_order():
+    text = 'first {"a": 1}, then {"b": {"c": "quote \\" and }"}}'
+    spans = agentinterface._find_json_objects(text)
+    assert [json.loads(span) for span in spans] == [
+        {'a': 1}, {'b': {'c': 'quote " and }'}}]
+
+
+def test_find_json_objects_many_stray_braces_is_fast():
+    action = '{"action": "get_node", "parameters": {}}'
+    texts = ['use {braces ' * 16000 + action,
+             '{see ' * 4000 + action + '}' * 4000,
+             '{"a": ' * 4000 + action,
+             '{"a": 1, invalid} ' * 16000 + action]
+    begin = time.perf_counter()
+    for text in texts:
+        assert agentinterface._find_json_objects(text) == [action]
+    assert time.perf_counter() - begin < 1